@@ -0,0 +1,81 @@
+import os
+import sys
+import time
+import argparse
+from statistics import pstdev
+
+import hardware
+from sampling import trimmed_mean
+
+# Throughput and noise of the MCP3008 reads: single reads and bursts over software and hardware SPI
+# Run on the Pi with the sensor powered (the app switches the sensor power relay on for the run):
+#
+#   python3 adc_benchmark.py [--channel 0] [--reads 1000] [--burst 256]
+#
+# With HARDWARE=sim it runs against the simulator timings, only useful to try the script.
+
+def bench(backend, channel, reads, burst, repeats):
+
+    result = {}
+
+    start = time.perf_counter()
+    single = [backend.read_adc(channel) for i in range(reads)]
+    duration = time.perf_counter() - start
+    result['single reads/s'] = reads / duration
+    result['single noise (sd)'] = pstdev(single)
+
+    start = time.perf_counter()
+    filtered = [trimmed_mean(backend.read_adc_burst([channel], burst)[channel]) for i in range(repeats)]
+    duration = time.perf_counter() - start
+    result['burst reads/s'] = burst * repeats / duration
+    result['burst ms'] = duration / repeats * 1000
+    result['filtered noise (sd)'] = pstdev(filtered)
+
+    return result
+
+def main(args):
+
+    parser = argparse.ArgumentParser(description='Compare MCP3008 throughput over software and hardware SPI')
+    parser.add_argument('--channel', type=int, default=0)
+    parser.add_argument('--reads', type=int, default=1000, help='single reads per mode')
+    parser.add_argument('--burst', type=int, default=256, help='readings per burst')
+    parser.add_argument('--repeats', type=int, default=20, help='bursts per mode')
+    parser.add_argument('--power-channel', type=int, default=6, help='sensor power relay')
+    args = parser.parse_args(args)
+
+    if os.environ.get('HARDWARE', 'pi') == 'sim':
+        backends = [('sim', hardware.get_backend())]
+    else:
+        # hardware first: software SPI sets GPIO 8-11 up as plain GPIO, which takes them out of their SPI0 (ALT0)
+        # function, so hardware SPI reads garbage after it until the pins are set back or the Pi is rebooted
+        backends = [('hardware', hardware.PiBackend('hardware')), ('software', hardware.PiBackend('software'))]
+
+    power = backends[0][1]
+    power.setup_relay(args.power_channel)
+    power.relay(args.power_channel, True)
+    try:
+        # sensor needs to stabilize after power on
+        time.sleep(15)
+        rows = []
+        for name, backend in backends:
+            try:
+                rows.append((name, bench(backend, args.channel, args.reads, args.burst, args.repeats)))
+            except (ImportError, IOError, RuntimeError) as error:
+                print(name, 'SPI not available:', error)
+            if name == 'software':
+                # release the software SPI pins (they are left as inputs, not ALT0)
+                backend.get_gpio().cleanup([backend.CLK, backend.MISO, backend.MOSI, backend.CS])
+                print('GPIO 8-11 were used as software SPI: run raspi-gpio set 8-11 a0 (or reboot) before using hardware SPI again')
+    finally:
+        power.relay(args.power_channel, False)
+
+    if len(rows) == 0:
+        return 1
+    print('{:<10} {:>16} {:>16} {:>14} {:>10} {:>18}'.format('spi', 'single reads/s', 'burst reads/s', 'single sd', 'burst ms', 'filtered sd'))
+    for name, res in rows:
+        print('{:<10} {:>16.0f} {:>16.0f} {:>14.2f} {:>10.2f} {:>18.2f}'.format(name, res['single reads/s'], res['burst reads/s'],
+            res['single noise (sd)'], res['burst ms'], res['filtered noise (sd)']))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,172 +1,242 @@
 from flask import Flask
 from flask import render_template
 from flask import request
+from flask import Response
+from flask import url_for
 from flask import g
+from flask import has_request_context
+from flask import before_render_template, template_rendered
+from werkzeug.http import is_resource_modified
+
 from math import sqrt
 
+import zlib
+
 import sqlite3
 
 import calendar
 from datetime import datetime, timedelta, timezone
 
+import os
 import time
-import board
-import Adafruit_GPIO.SPI as SPI
-import Adafruit_MCP3008
-from gpiozero import CPUTemperature
-import RPi.GPIO as GPIO
 
-import subprocess
+import atexit
+
+import storage
+import rollup
+import series
+import irrigation_cycle
+import hardware
+import metrics
+import cache
+import events
+import export
+import write_buffer
+import retention
+import sync_agent
+from scheduler import SamplingScheduler
+from sampling import Sampler, sample_all, trimmed_mean
 
 # WARNING: no authentication required in this experimental version so make sure you don't expose to the internet!
 # If you understand what this means, remove line 491 in handle_post() to allow POSTs and potentially anyone to control your valve
 # This is an alpha version hacked together in a few hours. If interested in this project, come back later for an improved version and use this script for inspiration only
 
 # INITIALIZATIONS 
-DATABASE = 'db/database.db'
-
-# Initial the dht device, with data pin connected to:
-# This causes libgpiod_pulsei to hang on 100% CPU > moved to separate thread for now
-#dhtDevice = adafruit_dht.DHT22(board.D24)  # pin 18 / GPIO 24
-dhtDevice = None
-
-# Software SPI configuration:
-# MCP3008 CLK   to Pi pin 18    > GPIO 11 (23)
-# MCP3008 DOUT  to Pi pin 23    > GPIO 09 (21)
-# MCP3008 DIN   to Pi pin 24    > GPIO 10 (19)
-# MCP3008 CS/SHDN to Pi pin 25  > GPIO 08 (24)
-CLK  = 11
-MISO = 9
-MOSI = 10
-CS   = 8
-mcp = Adafruit_MCP3008.MCP3008(clk=CLK, cs=CS, miso=MISO, mosi=MOSI)
+DATABASE = storage.DATABASE
+
+# Hardware (GPIO, MCP3008, DHT22, CPU temp) is in hardware.py and only loaded when used; HARDWARE=sim runs without a Pi
+# The DHT22 is read by a separate worker process as libgpiod can hang on 100% CPU (see dht_worker.py)
+atexit.register(lambda: hardware.get_backend().close())
 
 channel_pump = 5
 sensor_power_switch = 6 # channel 6 connected to relay and only powers all sensors if turned on (turn off after use because sensors can overheat if on for too long)
-sig_on = GPIO.LOW
-sig_off = GPIO.HIGH
-
-# GPIO setup
-GPIO.setmode(GPIO.BCM)
 
 # Valve control
-GPIO.setup(channel_pump, GPIO.OUT)
-GPIO.output(channel_pump, sig_off) # need this on initialization to ensure pump is/stays off
+hardware.get_backend().setup_relay(channel_pump) # need this on initialization to ensure pump is/stays off
 
 # Sensor power control
-GPIO.setup(sensor_power_switch, GPIO.OUT)
-GPIO.output(sensor_power_switch, sig_off) # need this on initialization to ensure sensors are powered off
+hardware.get_backend().setup_relay(sensor_power_switch) # need this on initialization to ensure sensors are powered off
+
+# Minutes between measurements taken by the built in scheduler; 0 disables it (e.g. when cron still calls /store_measures)
+SAMPLE_INTERVAL = int(os.environ.get('SAMPLE_INTERVAL', 0))
+
+# Readings per moisture sample in burst mode: every sample is the filtered value of an ADC_BURST readings burst
+# (milliseconds over hardware SPI) so a few samples are enough; 0 reads single values as before
+ADC_BURST = int(os.environ.get('ADC_BURST', 0))
+
+# Seconds to let the sensors stabalize after power on, and to wait after power off
+SENSOR_WARMUP = 15
+SENSOR_COOLDOWN = 1
 
 app = Flask(__name__)
 
+# create/migrate database schema once at startup
+storage.init_schema()
+
+# Retention (see retention.py): RETENTION_RAW_DAYS of raw measures, RETENTION_HOURLY_DAYS of hourly rollups,
+# daily rollups forever; 0 (default) keeps everything. The first time it's enabled the database is switched to
+# incremental auto vacuum (one full VACUUM), before anything else uses the database
+RETENTION_RAW_DAYS = int(os.environ.get('RETENTION_RAW_DAYS', 0))
+RETENTION_HOURLY_DAYS = int(os.environ.get('RETENTION_HOURLY_DAYS', 365)) if RETENTION_RAW_DAYS > 0 else 0
+if RETENTION_RAW_DAYS > 0:
+    retention.enable_incremental_vacuum()
+    retention.RetentionWorker(RETENTION_RAW_DAYS, RETENTION_HOURLY_DAYS).start()
+
+# Rendered pages and downsampled series are cached until the next measurement or valve switch (see cache.py)
+# CACHE_MAX_BYTES=0 disables the cache
+response_cache = cache.ResponseCache(int(os.environ.get('CACHE_MAX_BYTES', 4 * 1024 * 1024)), int(os.environ.get('CACHE_MAX_AGE', 60)))
+
+# New measures and valve switches are pushed to open pages through /events (see events.py)
+event_broker = events.EventBroker()
+
+# Optional write-behind buffer (see write_buffer.py): WRITE_BUFFER_INTERVAL seconds between group commits,
+# or earlier when WRITE_BUFFER_BATCH writes are waiting; 0 (default) writes every measurement/valve switch straight away
+WRITE_BUFFER_INTERVAL = int(os.environ.get('WRITE_BUFFER_INTERVAL', 0))
+buffer = None
+if WRITE_BUFFER_INTERVAL > 0:
+    buffer = write_buffer.WriteBuffer(WRITE_BUFFER_INTERVAL, int(os.environ.get('WRITE_BUFFER_BATCH', 100)), on_flush=response_cache.bump)
+    buffer.start()
+    # atexit runs in reverse order: flush before the hardware is closed
+    atexit.register(buffer.close)
+
+# Fleet sync (see sync_agent.py): SYNC_COLLECTOR=http://collector:5001 sends all measures and valve switches to the
+# collector, as SYNC_NODE (default host name); SYNC_TOKEN if the collector requires one
+syncer = None
+if os.environ.get('SYNC_COLLECTOR'):
+    syncer = sync_agent.SyncAgent(os.environ['SYNC_COLLECTOR'], os.environ.get('SYNC_NODE'), interval=int(os.environ.get('SYNC_INTERVAL', 300)), token=os.environ.get('SYNC_TOKEN'))
+    syncer.start()
+elif storage.get_connection().execute('SELECT name FROM sqlite_master WHERE type = \'trigger\' AND name = \'sync_measure_insert\'').fetchone() is not None:
+    # outbox triggers of an earlier sync keep queueing every write
+    print('Sync outbox is still filled but SYNC_COLLECTOR is not set, remove it with: python3 sync_agent.py --uninstall')
+
 def get_db():
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-    return db
+    # connection is kept open and reused by this thread (see storage.py)
+    return storage.get_connection()
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.commit()
-        db.close()
+    db = storage.get_connection()
+    if db.in_transaction:
+        # nothing should be left open by a request, don't keep locks between requests
+        db.rollback()
+
+metrics.describe('irrigation_http_request_seconds', 'Time to handle a request (streamed bodies excluded) per endpoint')
+metrics.describe('irrigation_db_query_seconds', 'SQLite query time per route')
+metrics.describe('irrigation_template_render_seconds', 'Jinja render time per template')
+metrics.describe('irrigation_measure_stage_seconds', 'Duration of the stages of a measurement')
+metrics.describe('irrigation_sensor_read_seconds', 'Duration of a single sensor read')
+metrics.describe('irrigation_sensor_read_failures_total', 'Sensor reads without a valid value (e.g. DHT22 0|0)')
+metrics.describe('irrigation_water_control_seconds', 'Duration of a valve switch')
+metrics.describe('irrigation_series_stream_seconds', 'Time to query and stream /api/series')
+metrics.describe('irrigation_downsample_seconds', 'LTTB downsampling time per series of /api/series')
+metrics.describe('irrigation_write_flush_seconds', 'Time to write a batch of the write buffer')
+metrics.describe('irrigation_write_batch_size', 'Writes (measurements, valve switches) per write buffer flush', [1, 2, 5, 10, 20, 50, 100, 200, 500])
+metrics.describe('irrigation_retention_deleted_rows_total', 'Rows removed by retention per table')
+metrics.describe('irrigation_retention_run_seconds', 'Duration of a retention pass (including pauses between batches)')
+metrics.describe('irrigation_sync_send_seconds', 'Time to send a batch to the fleet collector')
+metrics.describe('irrigation_sync_rows_total', 'Rows acknowledged by the fleet collector')
+metrics.describe('irrigation_sync_bytes_total', 'Compressed bytes sent to the fleet collector')
+metrics.describe('irrigation_sync_failures_total', 'Failed syncs (collector offline or failing)')
+metrics.describe('irrigation_export_seconds', 'Time to stream an export per table and format')
+metrics.describe('irrigation_cache_requests_total', 'Response cache lookups by result (hit/miss)')
+metrics.describe('irrigation_cache_evictions_total', 'Response cache entries evicted to stay below the memory cap')
+metrics.describe('irrigation_cache_invalidations_total', 'Data version bumps (measurement stored, valve switched)')
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    if request.headers.get('X-Profile'):
+        # per request profile returned in the Server-Timing header
+        metrics.start_profile()
+
+@app.after_request
+def stop_request_timer(response):
+    duration = time.perf_counter() - g.request_start
+    metrics.observe('irrigation_http_request_seconds', duration, endpoint=request.endpoint or 'unknown')
+    profile = metrics.stop_profile()
+    if profile is not None:
+        timings = ['{};dur={:.2f}'.format(name.replace('irrigation_', '').replace('_seconds', ''), value * 1000) for name, value in profile.items()]
+        timings.append('total;dur={:.2f}'.format(duration * 1000))
+        response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+def start_render_timer(sender, template, context, **extra):
+    g.render_start = time.perf_counter()
+
+def stop_render_timer(sender, template, context, **extra):
+    if 'render_start' in g:
+        metrics.record('irrigation_template_render_seconds', time.perf_counter() - g.render_start, template=template.name)
+
+before_render_template.connect(start_render_timer, app)
+template_rendered.connect(stop_render_timer, app)
+
+@app.route('/metrics')
+def metrics_endpoint():
+
+    # Prometheus text format, DHT22 worker counters as gauges
+    gauges = {}
+    for name, value in hardware.get_backend().sensor_stats().items():
+        gauges['irrigation_dht_' + name] = value
+    for name, value in response_cache.stats().items():
+        gauges['irrigation_cache_' + name] = value
+    for name, value in event_broker.stats().items():
+        gauges['irrigation_events_' + name] = value
+    if buffer is not None:
+        for name, value in buffer.stats().items():
+            gauges['irrigation_write_buffer_' + name] = value
+    if syncer is not None:
+        gauges['irrigation_sync_backlog'] = syncer.backlog()
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+def cached_page(render):
+
+    # rendered page for this url from the cache, rendered and stored when not cached (yet)
+    key = response_cache.key(request.path, request.args.items(multi=True))
+    page = response_cache.get(key)
+    if page is None:
+        page = render()
+        response_cache.put(key, page, len(page.encode()))
+    return page
 
 @app.route('/irrictrl')
 def index():
+    return cached_page(render_index)
 
+def render_index():
+
+    # recent irrigation cycles, grouped by all cycles that where supplied within one hour (see irrigation_cycle.py)
+    days = request.args.get('days', 21, type=int)
+    days = min(max(days, 1), 3650)
     irri_cycles = []
     with app.app_context():
         try:
-
-            # build list with recent irrigation cycles, grouped by all cycles that where supplied within one hour
-            cycles_group = [] 
-
-            # 0 valve, 1 dt, 2 status, 3 source, 4 control_type
-            start_dt = datetime.now() - timedelta(days=21)
-            is_first = True
-            for res in query_db('select * from irrigation_log where dt >= ? order by dt asc', (start_dt, )):
-
-                row = {}
-                dt = dt_utc2local(datetime.fromisoformat(res[1]), 'python')
-                row['dt'] = dt
-                row['dt_friendly'] = dt.strftime("%a %d/%m %H:%M") #:%S")
-                row['valve_id'] = '#' + str(res[0])[6:]
-                row['status'] = str(res[2]) 
-                if row['status'] == 'status_on':
-                    row['status'] = 'ON'
-                elif row['status'] == 'status_off':
-                    row['status'] = 'OFF'
-                #row['source'] = str(res[3]) 
-                row['control_type'] = str(res[4]) 
-                row['test'] = False
-                if 'Test' in row['control_type']:
-                    row['test'] = True
-                
-                if is_first and row['status'] == 'OFF':
-                    # this can happen with sql select on date and should ignore this item (next one will be ON)
-                    continue
-                is_first = False
-
-                # now loop all other irrigation logs in the group and determine if this is new cycle or add to current
-                match = False
-                for c in cycles_group:
-                    if row['valve_id'] == c['valve_id'] and row['dt'] >= c['dt_cycle_range_start'] and row['dt'] <= c['dt_cycle_range_end']:
-                        # add this to current cycles 
-                        c['data'].append(row)
-                        match = True
-
-                if not match:
-                    # new cycle
-                    c = {}
-                    c['valve_id'] = row['valve_id']
-                    c['dt_cycle_range_start'] = row['dt'] - timedelta(hours=1)
-                    c['dt_cycle_range_end'] = row['dt'] + timedelta(hours=1)
-                    c['data'] = []
-                    c['data'].append(row)
-                    cycles_group.append(c)
-                    #print(c)
-
-            # all data is in cycles_group now - do calc and add summary for each cycle
-            for ci in range(len(cycles_group)):
-
-                c = cycles_group[ci]
-                is_last_cycle = (ci == (len(cycles_group) - 1))
-
-                if len(c['data']) < 2 or (len(c['data']) % 2) != 0:
-                    # invalid
-                    print('Invalid cycle group data, length should be 2 minimum (1 ON, 1 OFF) and even item length')
-                    continue
-
-                # data should be in asc order so expect ON OFF ON OFF
-                c['dt_start'] = c['data'][0]['dt_friendly'] # first data el
-                c['dt_finish'] = c['data'][-1]['dt_friendly'] # last data el
-                c['total_cycles'] = int(len(c['data']) / 2) # should not require round as number of items is even (equal amount of ON and OFF)
-                c['total_seconds'] = 0 # sumarise below
-                c['age'] = ''
+            start_dt = datetime.now() - timedelta(days=days)
+            with metrics.timer('irrigation_db_query_seconds', route='index'):
+                rows = irrigation_cycle.query_cycles(get_db().cursor(), start_dt)
+
+            # 0 valve, 1 dt_start, 2 dt_end, 3 pulses, 4 total_seconds, 5 total_ml, 6 is_test
+            for ci in range(len(rows)):
+
+                res = rows[ci]
+                is_last_cycle = (ci == (len(rows) - 1))
+                dt_start = dt_utc2local(datetime.fromisoformat(res[1]), 'python')
+                dt_end = dt_utc2local(datetime.fromisoformat(res[2]), 'python')
+
+                c = {}
+                c['valve_id'] = '#' + str(res[0])[6:]
+                c['dt_start'] = dt_start.strftime("%a %d/%m %H:%M") #:%S")
+                c['dt_finish'] = dt_end.strftime("%a %d/%m %H:%M")
+                c['total_cycles'] = res[3]
+                c['total_seconds'] = int(round(res[4], 0))
+                c['total_ml'] = res[5]
+                c['test'] = bool(res[6])
                 if is_last_cycle:
                     # time since last cycle (dynamic age until now)
-                    c['age'] = str(dt_utc2local(datetime.now(), 'python') - c['data'][0]['dt'])[0:-13] + ' h.'
+                    c['age'] = str(dt_utc2local(datetime.now(), 'python') - dt_start)[0:-13] + ' h.'
                 else:
                     # time since prev cycle (can't tell first cycle unless query db for older one)
-                    c['age'] = str(cycles_group[ci + 1]['data'][-1]['dt'] - c['data'][0]['dt'])[0:-13] + ' h.'
-
-                #for i in range(len(c['data']),,2):
-                for i in range(len(c['data'])):
-
-                    # merge this item and next one for calculation (one cycle ON+OFF); ignore odd index (even is ON, odd is OFF)
-                    if (i % 2) != 0:
-                        continue
-
-                    start_c = c['data'][i]
-                    end_c = c['data'][i+1]
-                    duration = (end_c['dt'] - start_c['dt']).total_seconds()
-                    c['total_seconds'] = c['total_seconds'] + duration
-                    
-                c['total_ml'] = int(round(1 * c['total_seconds'], 1)) # best guess, amount is ~1ml per second with 2bar water pressure (regulated)
-                c['total_seconds'] = int(round(c['total_seconds'], 0))
-                
-                #unset(c['data'])
+                    c['age'] = str(dt_utc2local(datetime.fromisoformat(rows[ci + 1][2]), 'python') - dt_start)[0:-13] + ' h.'
+
                 irri_cycles.append(c)
 
             # reverse order to desc
@@ -174,134 +244,154 @@ def index():
 
         except RuntimeError as error:
             print(error.args[0])
+        except sqlite3.OperationalError as error:
+            # no valve switched yet
+            print(error.args[0])
 
-    return render_template('valvectrl.html', irri_cycles=irri_cycles) 
+    return render_template('valvectrl.html', irri_cycles=irri_cycles, days=days)
 
 @app.route('/store_measures')
 def store_measures():
 
-    # turn on sensors first
-    GPIO.output(sensor_power_switch, sig_on)  # Turn sensor power on
-
-    # wait 15 seconds for sensors to stabalize
-    time.sleep(15)
+    # measuring takes ~45 seconds so only queue it here, poll /store_measures/<job_id> for the result
+    return scheduler.trigger(request.args.get('source', 'web'))
+
+@app.route('/store_measures/<job_id>')
+def store_measures_status(job_id):
+
+    job = scheduler.status(job_id)
+    if job is None:
+        return {'error': 'Unknown job'}, 404
+    return job
+
+def read_dht():
+
+    try:
+        # Temp from DHT22 AM2302
+        # Now in worker process to prevent freezing unreliable libio
+        output = hardware.get_backend().read_dht()
+        if len(output) == 0:
+            print("No data in DHT22 sensor output")
+            return None
+
+        #print("DHT22 Sensor output:", output)
+        temperature_c, humidity = output.split('|')
+
+        # convert values back to numeric
+        temperature_c = float(temperature_c)
+        humidity = float(humidity)
+
+    except RuntimeError as error:
+        # Errors happen fairly often, DHT's are hard to read, just keep going
+        print(error.args[0])
+        return None
+
+    if temperature_c > 50 or temperature_c <= 0 or humidity > 100 or humidity < 0:
+        # invid reading (0|0 is returned by the worker on errors)
+        return None
+
+    return {'temp': temperature_c, 'humid': humidity}
+
+def read_moist():
+
+    try:
+        # Soil moisture from Capacitive soil moisture sensor v1.2 anolog sensor via MCP3008 DA
+        if ADC_BURST > 0:
+            burst = hardware.get_backend().read_adc_burst([0], ADC_BURST)
+            return {'moist': round(trimmed_mean(burst[0]), 1)}
+        return {'moist': hardware.get_backend().read_adc(0)} # moist sensor signal is connected to channel 0
+    except RuntimeError as error:
+        print(error.args[0])
+        return None
+
+def read_cpu():
+
+    try:
+        # Pi system CPU temp
+        return {'cpu': hardware.get_backend().cpu_temperature()}
+    except RuntimeError as error:
+        print(error.args[0])
+        return None
+
+# Samples and pause (seconds) per sensor, all sensors are sampled in parallel while sensor power is on
+# DHT22 can't be read more than once every 2 seconds, the ADC is fast so take many samples there
+# (in burst mode every sample already averages a burst, 5 filtered samples are done in under a second)
+samplers = [
+    Sampler('dht', read_dht, 3, 2.5),
+    Sampler('moist', read_moist, 5, 0.2) if ADC_BURST > 0 else Sampler('moist', read_moist, 32, 0.2),
+    Sampler('cpu', read_cpu, 3, 1),
+]
+
+def take_measures():
 
-    channel = 0 # moist sensor signal is connected to channel 0
+    # turn on sensors first
+    hardware.get_backend().relay(sensor_power_switch, True)  # Turn sensor power on
 
-    # Iterate over all sensors and take 10 samples with 4 second pause time
-    sleep_time = 5
-    samples_count = 5
-    sensor = dict()
-    sensor['temp'] = []
-    sensor['humid'] = []
-    sensor['moist'] = []
-    sensor['cpu'] = []
+    # wait for sensors to stabalize
+    with metrics.timer('irrigation_measure_stage_seconds', stage='warmup'):
+        time.sleep(SENSOR_WARMUP)
 
     timestamp = datetime.now()
 
-    # collect the samples from all sensors; improve this to modular aproach later and allow for custom frequencies per sensor
-    for i in range(samples_count):
-
-        try:
-            # Temp from DHT22 AM2302
-            # Now in subprocess to prevent freezing unreliable libio
-            output = subprocess.check_output(['/usr/bin/python3', './dhtsensor_standalone.py'])
-            output = output.decode().rstrip()
-            if len(output) > 0:
-                
-                #print("DHT22 Sensor output:", output)
-                temperature_c, humidity = output.split('|')
-
-                # convert values back to numeric
-                temperature_c = float(temperature_c)
-                humidity = float(humidity)
-
-                if temperature_c > 50 or temperature_c < 0 or humidity > 100 or humidity < 0:
-                    # invid reading
-                    temperature_c = 0
-                    humidity = 0
-
-            else:
-                print("No data in DHT22 sensor output")
-                temperature_c = 0
-                humidity = 0
-
-        except RuntimeError as error:
-            # Errors happen fairly often, DHT's are hard to read, just keep going
-            print(error.args[0])
-            temperature_c = 0
-            humidity = 0
-
-        try:
-            # Soil moisture from Capacitive soil moisture sensor v1.2 anolog sensor via MCP3008 DA
-            moist_level = mcp.read_adc(0)
-        except RuntimeError as error:
-            print(error.args[0])
-            moist_level = 0
-
-        try:
-            # Pi system CPU temp
-            cpu = CPUTemperature()
-            cpu_c = cpu.temperature
-        except RuntimeError as error:
-            print(error.args[0])
-            cpu_c = 0
-
-        #measure_vals = "It. {} | Temp: {:.1f} C    Humidity: {}%    Moist volt {}    CPU temp: {} C".format(i, temperature_c, humidity, moist_level, cpu_c)
-        #print(measure_vals)
-        if temperature_c > 0:
-            sensor['temp'].append(temperature_c)
-            sensor['humid'].append(humidity)
-        sensor['moist'].append(moist_level)
-        sensor['cpu'].append(cpu_c)
-        time.sleep(sleep_time)
-
-    # turn sensors off
-    GPIO.output(sensor_power_switch, sig_off)  # Turn sensor power off
-    time.sleep(1)
-
-    # Check if we have measures from temp sensor; sometimes we don't get any reading at all so just store 0 for now to measure how often this happens
-    if len(sensor['temp']) == 0:
-        sensor['temp'].append(0)
-        sensor['humid'].append(0)
-
-    # Get db cursor
-    with app.app_context():
-        cur = None
-        try:
-            db = get_db()
-            cur = db.cursor()
-
-            # init db (once)
-            cur.execute('CREATE TABLE IF NOT EXISTS measure_val (sensor TEXT, dt TEXT, val REAL)')
-            db.commit()
-
-        except RuntimeError as error:
-            print(error.args[0])
-
-        # Now go normalise these values
-        sensors = ['temp', 'humid', 'moist', 'cpu']
-        for s in sensors:
-            if len(sensor[s]) > 1:
-                value_norm, mean = normalize_average(sensor[s])
-                value_norm = round(value_norm, 1)
-            else:
-                value_norm = round(sensor[s][0], 1)
-
-            # Store values in database
-            if not cur:
-                print('Cannot insert in db (have no cursor)')
-            else:
-                cur.execute('INSERT INTO measure_val (sensor, dt, val) VALUES (?, ?, ?)',
-                    (s, timestamp, value_norm))
-                db.commit
+    # collect the samples from all sensors, each sensor on its own thread and frequency
+    try:
+        with metrics.timer('irrigation_measure_stage_seconds', stage='sampling'):
+            sensor = sample_all(samplers)
+    finally:
+        # turn sensors off
+        hardware.get_backend().relay(sensor_power_switch, False)  # Turn sensor power off
+    time.sleep(SENSOR_COOLDOWN)
+
+    # keep the raw samples so the normalisation can be redone later (see renormalize.py)
+    samples = {s: list(lst) for s, lst in sensor.items()}
+
+    # Check if we have measures from all sensors; sometimes we don't get any reading at all so just store 0 for now to measure how often this happens
+    for s in ['temp', 'humid', 'moist', 'cpu']:
+        if len(sensor.get(s, [])) == 0:
+            sensor[s] = [0]
+
+    # Now go normalise these values
+    values = {}
+    sensors = ['temp', 'humid', 'moist', 'cpu']
+    for s in sensors:
+        if len(sensor[s]) > 1:
+            value_norm, mean = normalize_average(sensor[s])
+            values[s] = round(value_norm, 1)
+        else:
+            values[s] = round(sensor[s][0], 1)
 
-        return ''
+    # Store values in database, all sensors in one transaction (or with the next flush of the write buffer)
+    with metrics.timer('irrigation_measure_stage_seconds', stage='store'):
+        if buffer is not None:
+            buffer.add_measures(timestamp, values, samples)
+        else:
+            with storage.transaction() as cur:
+                storage.insert_measures(cur, timestamp, values, samples)
+            response_cache.bump()
+    metrics.inc('irrigation_measures_total')
+
+    # same layout as /api/series: epoch ms and the values of this measurement
+    live = {'t': int(timestamp.timestamp()) * 1000}
+    for s in sensors:
+        if rollup.is_valid(s, values[s]):
+            live[s] = values[s]
+    event_broker.publish('measure', live)
+    if syncer is not None:
+        syncer.wake()
+
+scheduler = SamplingScheduler(take_measures, SAMPLE_INTERVAL)
+scheduler.start()
+
+@app.route('/sensor_stats')
+def sensor_stats():
+    # read latency and failure counters of the DHT22 worker
+    return hardware.get_backend().sensor_stats()
 
 def query_db(query, args=(), one=False):
-    cur = get_db().execute(query, args)
-    rv = cur.fetchall()
-    cur.close()
+    with metrics.timer('irrigation_db_query_seconds', route=request.endpoint if has_request_context() else 'job'):
+        cur = get_db().execute(query, args)
+        rv = cur.fetchall()
+        cur.close()
     return (rv[0] if rv else None) if one else rv
 
 def normalize_average(lst):
@@ -332,11 +422,11 @@ def water_control(valve_id, status, initiator):
         print('Invalid water control valve_id requested', valve_id)
         return False
 
-    valve_signal = sig_off # use as default to fail to status off
+    valve_on = False # use as default to fail to status off
     if status == 'status_on':
-        valve_signal = sig_on
+        valve_on = True
     elif status == 'status_off':
-        valve_signal = sig_off
+        valve_on = False
     else:
         print('Invalid water control status requested', status)
         return False
@@ -348,31 +438,23 @@ def water_control(valve_id, status, initiator):
         control_type = control_type + ' Test'
     timestamp = datetime.now()
 
-    # Log state change in db
-    # Get db cursor
-    with app.app_context():
-        cur = None
-        try:
-            db = get_db()
-            cur = db.cursor()
-
-            # init db (once)
-            cur.execute('CREATE TABLE IF NOT EXISTS irrigation_log (valve TEXT, dt TEXT, status TEXT, source TEXT, control_type TEXT)')
-            db.commit()
-
-        except RuntimeError as error:
-            print(error.args[0])
-
-        # Store values in database
-        if not cur:
-            print('Cannot insert in db (have no cursor)')
+    # Log state change in db (log and cycle summary in one transaction)
+    with metrics.timer('irrigation_water_control_seconds', stage='db'):
+        if buffer is not None:
+            # journaled straight away, written to the database with the next flush
+            buffer.add_irrigation_log(valve_id, timestamp, status, source, control_type, is_test)
         else:
-            cur.execute('INSERT INTO irrigation_log (valve, dt, status, source, control_type) VALUES (?, ?, ?, ?, ?)',
-                (valve_id, timestamp, status, source, control_type))
-            db.commit
+            with storage.transaction() as cur:
+                storage.insert_irrigation_log(cur, valve_id, timestamp, status, source, control_type, is_test)
+            response_cache.bump()
 
     if not is_test:
-        GPIO.output(valve_gpio_channel, valve_signal)  # Turn pump on/off
+        with metrics.timer('irrigation_water_control_seconds', stage='relay'):
+            hardware.get_backend().relay(valve_gpio_channel, valve_on)  # Turn pump on/off
+    metrics.inc('irrigation_valve_switch_total', valve=valve_id, status=status)
+    if syncer is not None:
+        syncer.wake()
+    event_broker.publish('valve', {'valve': valve_id, 't': int(dt_utc2local(timestamp, 'js').timestamp()) * 1000, 'v': 1 if valve_on else 0, 'test': is_test})
 
     return True
 
@@ -387,103 +469,241 @@ def dt_utc2local(dt, output_method):
 
 @app.route('/measures')
 def measures():
+    return cached_page(render_measures)
+
+# rows per page of /measures (?size= can ask for up to MEASURES_PAGE_MAX)
+MEASURES_PAGE_SIZE = int(os.environ.get('MEASURES_PAGE_SIZE', 50))
+MEASURES_PAGE_MAX = 500
+
+# one row per measurement: every sensor is a column by conditional aggregation, sensor ids are fixed (see storage.py)
+MEASURES_PIVOT = ('select ts, ' + ', '.join('max(case when sensor_id = {} then val end)'.format(storage.SENSORS.index(s) + 1) for s in storage.SENSORS) +
+    ' from measure where ts {} ? group by ts order by ts {} limit ?')
+
+def render_measures():
+
+    # keyset pagination on ts: ?before=<ts> pages to older rows, ?after=<ts> to newer ones, newest page without
+    # both pages are read from the ts index, so every page costs the same no matter how far back it is
+    size = min(max(request.args.get('size', MEASURES_PAGE_SIZE, type=int), 1), MEASURES_PAGE_MAX)
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
 
-    measure_vals = []    
+    rows = []
+    measure_vals = []
+    has_older = False
+    has_newer = False
     with app.app_context():
         try:
-            db = get_db()
-            cur = db.cursor()
-
-            row = {}
-            last_dt = None
-            # show data from last 7 days
-            start_dt = datetime.now() - timedelta(days=7, minutes=30)
-            for res in query_db('select * from measure_val where dt >= ? order by dt desc', (start_dt, )):
-                dt = res[1]
-                if dt != last_dt:
-                    # new row, add prev and reset
-                    last_dt = dt
-                    if last_dt != None:
-                        measure_vals.append(row)
-                        row = {}
-                    dt = dt_utc2local(datetime.fromisoformat(dt), 'python')
-                    row['dt'] = str(dt)[0:-10] #:49.518873
-                row['sensor_' + res[0]] = str(res[2]) 
-
-            if len(row) != 0:
+            if after is not None:
+                rows = query_db(MEASURES_PIVOT.format('>', 'asc'), (after, size + 1))
+                has_newer = len(rows) > size
+                rows = rows[:size]
+                rows.reverse()
+            else:
+                rows = query_db(MEASURES_PIVOT.format('<', 'desc'), (before if before is not None else 2 ** 62, size + 1))
+                has_older = len(rows) > size
+                rows = rows[:size]
+
+            if len(rows) > 0:
+                # the direction we didn't page in: just check if there's any row beyond this page
+                if after is not None:
+                    has_older = query_db('select 1 from measure where ts < ? limit 1', (rows[-1][0], ), one=True) is not None
+                elif before is not None:
+                    has_newer = query_db('select 1 from measure where ts > ? limit 1', (rows[0][0], ), one=True) is not None
+
+            for res in rows:
+                row = {}
+                dt = dt_utc2local(datetime.fromtimestamp(res[0]), 'python')
+                row['dt'] = dt.strftime('%Y-%m-%d %H:%M')
+                for i, s in enumerate(storage.SENSORS):
+                    row['sensor_' + s] = str(res[i + 1]) if res[i + 1] is not None else ''
                 measure_vals.append(row)
 
         except RuntimeError as error:
             print(error.args[0])
 
-    return render_template('measures.html', measures=measure_vals) 
+    older = None
+    newer = None
+    if len(rows) > 0:
+        if has_older:
+            older = url_for('measures', before=rows[-1][0], size=size)
+        if has_newer:
+            newer = url_for('measures', after=rows[0][0], size=size)
+
+    return render_template('measures.html', measures=measure_vals, older=older, newer=newer)
 
 @app.route('/measures_chart')
 def measures_chart():
 
-    measures_moist = ''
-    measures_temp = ''
-    measures_humid = ''
-    measures_irri = ''
-    start_dt = datetime.now() - timedelta(days=7, minutes=30)
-    with app.app_context():
-        try:
-            db = get_db()
-            cur = db.cursor()
-
-            # This is crazy copy/paste for now, need to work on modular sensor logic
-            # Moist sensor
-            for res in query_db('select * from measure_val where sensor = \'moist\' and dt >= ? order by dt desc',(start_dt, )):
-                dt = dt_utc2local(datetime.fromisoformat(res[1]), 'js')
-                dt = int(dt.timestamp()) * 1000
-                val = res[2]
-                if val > 540 or val < 380:
-                    # invalid data; ignore
-                    continue
-
-                if measures_moist != '':
-                    measures_moist = measures_moist + ','
-                measures_moist = measures_moist + '{t: ' + str(dt) + ', y: -' + str(val) + '}'
-
-            # Temp sensor
-            for res in query_db('select * from measure_val where sensor = \'temp\' and dt >= ? order by dt desc', (start_dt, )):
-                dt = dt_utc2local(datetime.fromisoformat(res[1]), 'js')
-                dt = int(dt.timestamp()) * 1000
-                val = res[2]
-                if val <= 0:
-                    # won't expect temps below zero in Sydney, hopefully ;)
-                    continue
-                    
-                if measures_temp != '':
-                    measures_temp = measures_temp + ','
-                measures_temp = measures_temp + '{t: ' + str(dt) + ', y: ' + str(val) + '}'
-
-            # Humidity sensor
-            for res in query_db('select * from measure_val where sensor = \'humid\' and dt >= ? order by dt desc', (start_dt, )):
-                dt = dt_utc2local(datetime.fromisoformat(res[1]), 'js')
-                dt = int(dt.timestamp()) * 1000
-                val = res[2]
-                if val <= 0 or val > 100:
-                    continue
-                    
-                if measures_humid != '':
-                    measures_humid = measures_humid + ','
-                measures_humid = measures_humid + '{t: ' + str(dt) + ', y: ' + str(val) + '}'
-
-            # Include recent irrigation cycles
-            for res in query_db('select * from irrigation_log where dt >= ? order by dt desc', (start_dt, )):
-                dt = dt_utc2local(datetime.fromisoformat(res[1]), 'js')
-                dt = int(dt.timestamp()) * 1000
-                val = res[2]
-
-                if measures_irri != '':
-                    measures_irri = measures_irri + ','
-                measures_irri = measures_irri + '{t: ' + str(dt) + ', y: 10}'
+    # page only holds the charts, data is loaded from /api/series so the html itself stays cacheable
+    return cached_page(render_measures_chart)
 
-        except RuntimeError as error:
-            print(error.args[0])
+def render_measures_chart():
+
+    # range in days, e.g. 7 for last week, 90 for a quarter or 182 for a full season
+    days = request.args.get('days', 7, type=int)
+    days = min(max(days, 1), 3650)
+
+    return render_template('measures_chart.html', days=days)
 
-    return render_template('measures_chart.html', measures_moist=measures_moist, measures_temp=measures_temp, measures_humid=measures_humid, measures_irri=measures_irri)
+def parse_dt_param(value):
+
+    # accepts epoch milliseconds (as used by Javascript) or an ISO datetime string
+    if value is None or value == '':
+        return None
+    if value.isdigit():
+        return datetime.fromtimestamp(int(value) / 1000)
+    return datetime.fromisoformat(value)
+
+def data_version():
+
+    # cheap version of the data: newest measure and last irrigation_log rowid (index lookups, no scan needed)
+    version = []
+    last_modified = None
+
+    res = query_db('select max(ts) from measure', one=True)
+    if res is not None and res[0] is not None:
+        version.append(str(res[0]))
+        last_modified = datetime.fromtimestamp(res[0])
+    else:
+        version.append('0')
+
+    res = query_db('select rowid, dt from irrigation_log order by rowid desc limit 1', one=True)
+    if res is not None:
+        version.append(str(res[0]))
+        dt = datetime.fromisoformat(res[1])
+        if last_modified is None or dt > last_modified:
+            last_modified = dt
+    else:
+        version.append('0')
+
+    if last_modified is not None:
+        last_modified = last_modified.astimezone(timezone.utc)
+
+    return '-'.join(version), last_modified
+
+@app.route('/api/series')
+def api_series():
+
+    # columnar json, see series.py
+    # points=N downsamples every sensor series to at most N points (LTTB), irrigation events are never dropped
+    sensors = [x for x in request.args.get('sensors', 'moist,temp,humid,irrigation').split(',') if x != '']
+    try:
+        start_dt = parse_dt_param(request.args.get('start'))
+        end_dt = parse_dt_param(request.args.get('end'))
+    except ValueError:
+        return Response('Invalid start or end', status=400)
+    try:
+        points = int(request.args.get('points', 0))
+    except ValueError:
+        return Response('Invalid points', status=400)
+    if start_dt is None:
+        start_dt = datetime.now() - timedelta(days=7, minutes=30)
+
+    resolution = request.args.get('resolution', 'auto')
+    if resolution == 'auto':
+        resolution = rollup.pick_resolution(start_dt, end_dt or datetime.now())
+        # older raw measures/hourly rollups may have been removed already
+        resolution = retention.available_resolution(start_dt, resolution, RETENTION_RAW_DAYS, RETENTION_HOURLY_DAYS)
+    elif resolution != 'raw' and resolution not in rollup.ROLLUP_TABLES:
+        return Response('Invalid resolution', status=400)
+
+    version, last_modified = data_version()
+    etag = version + '-' + str(zlib.crc32((','.join(sensors) + '|' + str(start_dt) + '|' + str(end_dt) + '|' + resolution + '|' + str(points)).encode()))
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return Response(status=304)
+
+    def generate():
+
+        start = time.perf_counter()
+        cur = get_db().cursor()
+        for part in series.stream(cur, sensors, start_dt, end_dt, resolution, points):
+            yield part
+        cur.close()
+        metrics.observe('irrigation_series_stream_seconds', time.perf_counter() - start)
+
+    # downsampled series are small enough to keep, full resolution ones are only streamed
+    key = response_cache.key(request.path, request.args.items(multi=True)) if points > 0 else None
+    body = response_cache.get(key) if key is not None else None
+
+    def generate_cached():
+        chunks = []
+        for chunk in generate():
+            chunks.append(chunk)
+            yield chunk
+        body = ''.join(chunks)
+        response_cache.put(key, body, len(body))
+
+    if body is not None:
+        response = Response(body, mimetype='application/json')
+    elif key is not None:
+        response = Response(generate_cached(), mimetype='application/json')
+    else:
+        response = Response(generate(), mimetype='application/json')
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/export/<table>')
+def export_history(table):
+
+    # bulk download of the history, see export.py: ?format=csv|arrow&start=&end=&sensors=&gzip=1
+    if table not in export.TABLES:
+        return Response('Unknown table', status=404)
+    fmt = request.args.get('format', 'csv')
+    if fmt not in export.FORMATS:
+        return Response('Invalid format', status=400)
+    if fmt == 'arrow' and export.pa is None:
+        return Response('Arrow export needs pyarrow on the server', status=501)
+    try:
+        start_dt = parse_dt_param(request.args.get('start'))
+        end_dt = parse_dt_param(request.args.get('end'))
+    except ValueError:
+        return Response('Invalid start or end', status=400)
+    sensors = [x for x in request.args.get('sensors', ','.join(storage.SENSORS)).split(',') if x != '']
+    compress = request.args.get('gzip', '0') not in ('0', '')
+
+    def generate():
+        # own cursor on this thread's connection, rows are read chunk by chunk while sending
+        start = time.perf_counter()
+        cur = get_db().cursor()
+        try:
+            for block in export.export(cur, table, fmt, sensors, start_dt, end_dt, compress):
+                yield block
+        finally:
+            cur.close()
+            metrics.observe('irrigation_export_seconds', time.perf_counter() - start, table=table, format=fmt)
+
+    if compress:
+        mimetype = 'application/gzip'
+    elif fmt == 'arrow':
+        mimetype = 'application/vnd.apache.arrow.stream'
+    else:
+        mimetype = 'text/csv'
+    response = Response(generate(), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=' + export.file_name(table, fmt, compress)
+    return response
+
+@app.route('/events')
+def live_events():
+
+    # Server-Sent Events: 'measure' {"t": epoch ms, "moist": .., ..} after every stored measurement and
+    # 'valve' {"valve": .., "t": epoch ms, "v": 1 is ON, 0 is OFF} on every valve switch
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID', ''))
+    except ValueError:
+        last_event_id = None
+
+    q = event_broker.subscribe(last_event_id)
+    if q is None:
+        return Response('Too many live connections', status=503)
+
+    response = Response(event_broker.stream(q), mimetype='text/event-stream')
+    response.cache_control.no_cache = True
+    # don't let a proxy (nginx) buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/irrictrl/valvectrl', methods=['POST'])
 def handle_post():
@@ -0,0 +1,250 @@
+import os
+import sys
+import math
+import time
+import random
+import sqlite3
+import argparse
+import tracemalloc
+from datetime import datetime, timedelta
+
+# Benchmark of all routes against synthetic databases with 1 month, 1 year and 5 years of history
+# Runs on any Linux box: hardware is simulated (HARDWARE=sim) without delays.
+#
+#   python3 benchmark.py [--datasets 1m,1y,5y] [--runs 20] [--regenerate]
+#
+# Generated databases are kept in bench_data/ and reused on the next run.
+
+os.environ.setdefault('HARDWARE', 'sim')
+os.environ.setdefault('SIM_LATENCY', '0')
+# routes are timed rendering, comparable with runs from before the response cache; cache hits get their own column
+os.environ['CACHE_MAX_BYTES'] = '0'
+
+import storage
+import rollup
+import irrigation_cycle
+
+DATASETS = {
+    '1m': 30,
+    '1y': 365,
+    '5y': 5 * 365,
+}
+
+DATA_DIR = 'bench_data'
+
+ROUTES = [
+    '/irrictrl',
+    '/irrictrl?days=365',
+    '/measures',
+    '/measures?before={before_1y}',
+    '/measures_chart',
+    '/api/series',
+    '/api/series?resolution=raw&start={start_90d}',
+    '/api/series?start={start_season}',
+    '/api/series?start={start_all}',
+]
+
+def day_phase(dt):
+    # -1 at 3 am, peaks at 3 pm
+    return -math.cos((dt.hour * 60 + dt.minute - 3 * 60) / (24 * 60) * 2 * math.pi)
+
+def generate(path, days, seed=1):
+
+    # one measurement every 15-30 minutes, irrigation every 2-3 days in bursts of 3-5 ON/OFF pulses
+    if os.path.exists(path):
+        os.remove(path)
+    storage.init_schema(path)
+    db = storage.connect(path)
+    cur = db.cursor()
+    rng = random.Random(seed)
+
+    end = datetime.now()
+    dt = end - timedelta(days=days)
+    next_irrigation = dt + timedelta(days=rng.uniform(0, 3))
+    moist = 470.0
+    measures = []
+    logs = []
+    while dt < end:
+
+        if dt >= next_irrigation:
+            pulse = next_irrigation
+            for i in range(rng.randint(3, 5)):
+                logs.append(('valve_1', pulse, 'status_on', 'bench', 'Manual'))
+                logs.append(('valve_1', pulse + timedelta(seconds=rng.randint(30, 90)), 'status_off', 'bench', 'Manual'))
+                pulse = pulse + timedelta(minutes=10)
+            next_irrigation = next_irrigation + timedelta(days=rng.uniform(2, 3))
+            moist = 400.0
+
+        # soil dries out slowly, lower value is wetter
+        moist = min(500.0, moist + rng.uniform(0, 0.6))
+        ts = int(dt.timestamp())
+        temp = 20 + 6 * day_phase(dt) + rng.gauss(0, 0.5)
+        if rng.random() < 0.02:
+            # DHT22 failed on all samples
+            temp = 0
+        measures.append((1, ts, round(temp, 1)))
+        measures.append((2, ts, round(60 - 15 * day_phase(dt) + rng.gauss(0, 2), 1) if temp > 0 else 0))
+        measures.append((3, ts, round(moist + rng.gauss(0, 4), 1)))
+        measures.append((4, ts, round(45 + rng.gauss(0, 1), 1)))
+
+        if len(measures) >= 40000:
+            cur.executemany('INSERT OR REPLACE INTO measure (sensor_id, ts, val) VALUES (?, ?, ?)', measures)
+            measures = []
+
+        dt = dt + timedelta(seconds=rng.randint(15 * 60, 30 * 60))
+
+    cur.executemany('INSERT OR REPLACE INTO measure (sensor_id, ts, val) VALUES (?, ?, ?)', measures)
+    cur.executemany('INSERT INTO irrigation_log (valve, dt, status, source, control_type) VALUES (?, ?, ?, ?, ?)', logs)
+    rollup.rebuild_rollups(cur)
+    irrigation_cycle.rebuild_cycles(cur)
+    db.commit()
+    db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    db.close()
+
+def percentile(values, p):
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+def bench_route(client, url, runs):
+
+    # latency without tracemalloc overhead, then one extra run for the memory peak
+    latencies = []
+    size = 0
+    for i in range(runs):
+        start = time.perf_counter()
+        response = client.get(url)
+        body = response.get_data()
+        latencies.append(time.perf_counter() - start)
+        size = len(body)
+        if response.status_code != 200:
+            print('  ', url, 'returned', response.status_code)
+
+    tracemalloc.start()
+    client.get(url).get_data()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'peak_kb': peak / 1024,
+        'size_kb': size / 1024,
+    }
+
+def bench_cached(client, url, runs):
+
+    # p50 of cache hits: the first request fills the cache
+    client.get(url).get_data()
+    latencies = []
+    for i in range(runs):
+        start = time.perf_counter()
+        client.get(url).get_data()
+        latencies.append(time.perf_counter() - start)
+    return percentile(latencies, 50) * 1000
+
+def bench_job(app, runs):
+
+    # the measurement job itself (what /store_measures queues), without sensor warm-up and sampling pauses
+    # /store_measures is not in ROUTES: it starts this job on the scheduler thread, which would write to the
+    # database while the read routes are timed
+    latencies = []
+    for i in range(runs):
+        start = time.perf_counter()
+        app.take_measures()
+        latencies.append(time.perf_counter() - start)
+    return {
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'peak_kb': 0,
+        'size_kb': 0,
+    }
+
+def main(args):
+
+    parser = argparse.ArgumentParser(description='Benchmark all routes against synthetic datasets')
+    parser.add_argument('--datasets', default='1m,1y,5y', help='comma separated, any of ' + ','.join(DATASETS))
+    parser.add_argument('--runs', type=int, default=20, help='requests per route')
+    parser.add_argument('--regenerate', action='store_true', help='generate datasets even if they exist')
+    args = parser.parse_args(args)
+
+    names = [x for x in args.datasets.split(',') if x != '']
+    for name in names:
+        if name not in DATASETS:
+            parser.error('Unknown dataset ' + name)
+
+    os.makedirs(DATA_DIR, exist_ok=True)
+    for name in names:
+        path = os.path.join(DATA_DIR, name + '.db')
+        if args.regenerate or not os.path.exists(path):
+            print('Generating', name, 'dataset')
+            start = time.perf_counter()
+            generate(path, DATASETS[name])
+            print('  done in {:.1f} s, {:.1f} MB'.format(time.perf_counter() - start, os.path.getsize(path) / 1024 / 1024))
+
+    # app runs its startup (schema migration) on the first dataset
+    storage.DATABASE = os.path.join(DATA_DIR, names[0] + '.db')
+    import app
+    import cache
+    from sampling import Sampler
+    app.SENSOR_WARMUP = 0
+    app.SENSOR_COOLDOWN = 0
+    app.samplers = [Sampler(s.name, s.read, s.samples, 0) for s in app.samplers]
+    client = app.app.test_client()
+
+    now = datetime.now()
+    params = {
+        'start_90d': int((now - timedelta(days=90)).timestamp()) * 1000,
+        'start_season': int((now - timedelta(days=182)).timestamp()) * 1000,
+        'start_all': int((now - timedelta(days=10 * 365)).timestamp()) * 1000,
+        'before_1y': int((now - timedelta(days=365)).timestamp()),
+    }
+
+    print('{:<8} {:<48} {:>10} {:>10} {:>12} {:>10} {:>14}'.format('dataset', 'route', 'p50 ms', 'p95 ms', 'peak kB', 'size kB', 'cached p50 ms'))
+    for name in names:
+        path = os.path.join(DATA_DIR, name + '.db')
+        storage.DATABASE = app.DATABASE = path
+        storage.close_connection()
+
+        # warm up (page cache, template compile)
+        for route in ROUTES:
+            client.get(route.format(**params)).get_data()
+
+        results = []
+        for route in ROUTES:
+            results.append((route, bench_route(client, route.format(**params), args.runs)))
+
+        # same routes served from the response cache, as the app does by default
+        disabled = app.response_cache
+        app.response_cache = cache.ResponseCache()
+        for route, res in results:
+            res['cached_p50'] = bench_cached(client, route.format(**params), args.runs)
+        app.response_cache = disabled
+
+        # the job writes measures: run it on a copy so the kept datasets stay as generated
+        job_path = os.path.join(DATA_DIR, name + '-job.db')
+        src = sqlite3.connect(path)
+        dst = sqlite3.connect(job_path)
+        src.backup(dst)
+        src.close()
+        dst.close()
+        storage.DATABASE = app.DATABASE = job_path
+        results.append(('take_measures() job', bench_job(app, min(args.runs, 5))))
+        storage.close_connection()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(job_path + suffix):
+                os.remove(job_path + suffix)
+        storage.DATABASE = app.DATABASE = path
+
+        for route, res in results:
+            cached = '{:>14.1f}'.format(res['cached_p50']) if 'cached_p50' in res else '{:>14}'.format('-')
+            print('{:<8} {:<48} {:>10.1f} {:>10.1f} {:>12.0f} {:>10.1f} {}'.format(name, route[:48], res['p50'], res['p95'], res['peak_kb'], res['size_kb'], cached))
+
+        storage.close_connection()
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
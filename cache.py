@@ -0,0 +1,74 @@
+import time
+import threading
+from collections import OrderedDict
+
+import metrics
+
+# In-process LRU cache of rendered responses and computed datasets
+# Keys hold the data version: every write that changes what the pages show (a measurement, a valve switch)
+# calls bump(), which makes all cached entries stale and drops them. Entries also expire after max_age seconds
+# for pages showing times relative to now (e.g. the age of the last irrigation cycle).
+# Memory is capped by the total size of the cached bodies, least recently used entries are evicted first.
+
+class ResponseCache:
+
+    def __init__(self, max_bytes=4 * 1024 * 1024, max_age=60):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.version = 0
+
+    def key(self, route, params=()):
+        # params: any iterable of (name, value), e.g. request.args.items(multi=True)
+        return (route, tuple(sorted(params)), self.version)
+
+    def bump(self):
+        with self.lock:
+            self.version = self.version + 1
+            self.entries.clear()
+            self.size = 0
+        metrics.inc('irrigation_cache_invalidations_total')
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[2] > self.max_age:
+                self.remove(key)
+                entry = None
+            if entry is None:
+                metrics.inc('irrigation_cache_requests_total', result='miss')
+                return None
+            self.entries.move_to_end(key)
+        metrics.inc('irrigation_cache_requests_total', result='hit')
+        return entry[0]
+
+    def put(self, key, value, size):
+        # size in bytes of value, entries bigger than the cap are not cached
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key[2] != self.version:
+                # data changed while this was computed
+                return
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (value, size, time.monotonic())
+            self.size = self.size + size
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                metrics.inc('irrigation_cache_evictions_total')
+
+    def remove(self, key):
+        # lock must be held
+        entry = self.entries.pop(key)
+        self.size = self.size - entry[1]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'version': self.version,
+            }
@@ -0,0 +1,214 @@
+import os
+import re
+import sys
+import gzip
+import json
+import hashlib
+import time
+import argparse
+import sqlite3
+from datetime import datetime, timedelta
+
+from flask import Flask
+from flask import request
+from flask import Response
+
+import storage
+import rollup
+import series
+import metrics
+
+# Fleet collector: receives the batches of the sync agents (sync_agent.py) of all Pis and serves the same
+# /api/series as the app, for any node. Its database has the same schema as a Pi's: sensors and valves of
+# every node are named 'node/sensor' and 'node/valve'. sync_node keeps the sequence numbers and a digest of the
+# last batch per node and outbox epoch: that same batch sent again is acknowledged without storing it again, any
+# other batch with sequence numbers this epoch already used (database restored from a backup) is refused with 409
+# so the agent starts a new epoch. A new epoch starts with no sequence numbers.
+#
+#   python3 collector.py [--host 0.0.0.0] [--port 5001] [--database db/collector.db]
+#
+# COLLECTOR_TOKEN (optional) is the shared token the agents have to send.
+
+storage.DATABASE = os.environ.get('COLLECTOR_DATABASE', 'db/collector.db')
+TOKEN = os.environ.get('COLLECTOR_TOKEN')
+
+NODE_NAME = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+app = Flask(__name__)
+
+metrics.describe('irrigation_collector_ingest_seconds', 'Time to store a batch per node')
+metrics.describe('irrigation_collector_rows_total', 'Rows stored per node and table')
+metrics.describe('irrigation_collector_duplicate_batches_total', 'Batches received again (already stored) per node')
+metrics.describe('irrigation_collector_refused_batches_total', 'Batches refused for reused sequence numbers per node')
+
+def init_db(path=None):
+    storage.init_schema(path or storage.DATABASE)
+    db = storage.connect(path or storage.DATABASE)
+    columns = [res[1] for res in db.execute('PRAGMA table_info(sync_node)')]
+    if len(columns) > 0 and 'epoch' not in columns:
+        # collector database from before epochs: the nodes keep their sequence numbers under the empty epoch
+        db.execute('ALTER TABLE sync_node RENAME TO sync_node_old')
+    elif len(columns) > 0 and 'digest' not in columns:
+        db.execute('ALTER TABLE sync_node ADD COLUMN digest TEXT')
+    db.execute('CREATE TABLE IF NOT EXISTS sync_node (name TEXT NOT NULL, epoch TEXT NOT NULL, first_seq INTEGER NOT NULL, last_seq INTEGER NOT NULL, '
+        'last_seen INTEGER, batches INTEGER NOT NULL DEFAULT 0, rows INTEGER NOT NULL DEFAULT 0, digest TEXT, PRIMARY KEY (name, epoch))')
+    if len(columns) > 0 and 'epoch' not in columns:
+        db.execute('INSERT INTO sync_node (name, epoch, first_seq, last_seq, last_seen, batches, rows) '
+            'SELECT name, \'\', last_seq, last_seq, last_seen, batches, rows FROM sync_node_old')
+        db.execute('DROP TABLE sync_node_old')
+    db.commit()
+    db.close()
+
+def batch_digest(measures, irrigation):
+    return hashlib.sha256(json.dumps([measures, irrigation], sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+def ingest(cur, node, epoch, first_seq, last_seq, measures, irrigation):
+
+    # stores one batch, returns the last sequence number stored of this node and epoch, None when refused
+    # the agent only sends a batch once the one before is acknowledged, so the only batch it can send again is the
+    # last one stored, with the same sequence numbers and rows; any other batch overlapping the sequence numbers
+    # stored already has other rows under them
+    digest = batch_digest(measures, irrigation)
+    res = cur.execute('SELECT first_seq, last_seq, digest FROM sync_node WHERE name = ? AND epoch = ?', (node, epoch)).fetchone()
+    if res is not None and first_seq <= res[1]:
+        if first_seq == res[0] and last_seq == res[1] and digest == res[2]:
+            metrics.inc('irrigation_collector_duplicate_batches_total', node=node)
+            return res[1]
+        metrics.inc('irrigation_collector_refused_batches_total', node=node)
+        return None
+
+    # measures: one executemany, then the rollups of the range each sensor got rows for
+    rows = []
+    ranges = {}
+    for sensor, ts, val in zip(measures['sensor'], measures['ts'], measures['val']):
+        sensor_id = storage.get_sensor_id(cur, node + '/' + sensor)
+        rows.append((sensor_id, ts, val))
+        first, last = ranges.get(sensor_id, (ts, ts))
+        ranges[sensor_id] = (min(first, ts), max(last, ts))
+    cur.executemany('INSERT OR REPLACE INTO measure (sensor_id, ts, val) VALUES (?, ?, ?)', rows)
+    for sensor_id, (first, last) in ranges.items():
+        rollup.rebuild_rollups_range(cur, sensor_id, first, last)
+
+    # irrigation log has no key, skip events that are stored already (batch sent twice with a partial overlap)
+    cur.executemany('INSERT INTO irrigation_log (valve, dt, status, source, control_type) SELECT ?, ?, ?, ?, ? '
+        'WHERE NOT EXISTS (SELECT 1 FROM irrigation_log WHERE dt = ? AND valve = ? AND status = ?)',
+        [(node + '/' + res[0], res[1], res[2], res[3], res[4], res[1], node + '/' + res[0], res[2]) for res in irrigation])
+
+    cur.execute('INSERT INTO sync_node (name, epoch, first_seq, last_seq, last_seen, batches, rows, digest) VALUES (?, ?, ?, ?, ?, 1, ?, ?) '
+        'ON CONFLICT (name, epoch) DO UPDATE SET first_seq = excluded.first_seq, last_seq = excluded.last_seq, last_seen = excluded.last_seen, '
+        'batches = batches + 1, rows = rows + excluded.rows, digest = excluded.digest',
+        (node, epoch, first_seq, last_seq, int(time.time()), len(rows) + len(irrigation), digest))
+    metrics.inc('irrigation_collector_rows_total', len(rows), node=node, table='measure')
+    metrics.inc('irrigation_collector_rows_total', len(irrigation), node=node, table='irrigation_log')
+    return last_seq
+
+@app.route('/ingest', methods=['POST'])
+def ingest_batch():
+
+    if TOKEN and request.headers.get('Authorization') != 'Bearer ' + TOKEN:
+        return Response('Invalid token', status=403)
+
+    try:
+        data = request.get_data()
+        if request.headers.get('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        batch = json.loads(data)
+        node = batch['node']
+        if not isinstance(node, str):
+            raise TypeError('node')
+        epoch = str(batch.get('epoch') or '')
+        first_seq = int(batch['first_seq'])
+        last_seq = int(batch['last_seq'])
+        measures = batch.get('measures', {'sensor': [], 'ts': [], 'val': []})
+        irrigation = batch.get('irrigation', [])
+        # measures: equal length lists of sensor names, epoch seconds and values; irrigation: rows of 5 values
+        if not all(isinstance(measures.get(x), list) for x in ('sensor', 'ts', 'val')):
+            raise TypeError('measures')
+        if len(measures['sensor']) != len(measures['ts']) or len(measures['ts']) != len(measures['val']):
+            raise ValueError('measures')
+        if not all(isinstance(x, str) and x != '' for x in measures['sensor']) or not all(type(x) is int for x in measures['ts']) \
+                or not all(type(x) in (int, float) for x in measures['val']):
+            raise ValueError('measures')
+        if not all(isinstance(res, list) and len(res) == 5 and isinstance(res[0], str) and isinstance(res[1], str) for res in irrigation):
+            raise ValueError('irrigation')
+    except (ValueError, KeyError, TypeError, AttributeError, OSError):
+        return Response('Invalid batch', status=400)
+    if not NODE_NAME.match(node):
+        return Response('Invalid node name', status=400)
+
+    start = time.perf_counter()
+    try:
+        with storage.transaction() as cur:
+            stored = ingest(cur, node, epoch, first_seq, last_seq, measures, irrigation)
+    except sqlite3.Error:
+        # sensor ids cached in this transaction were rolled back as well
+        storage.sensor_ids.clear()
+        raise
+    if stored is None:
+        return Response('Sequence numbers ' + str(first_seq) + ' to ' + str(last_seq) + ' of epoch ' + epoch + ' were used for other rows', status=409)
+    metrics.observe('irrigation_collector_ingest_seconds', time.perf_counter() - start, node=node)
+    return {'node': node, 'epoch': epoch, 'last_seq': stored}
+
+@app.route('/nodes')
+def nodes():
+
+    # nodes with the epoch of their last batch, totals over all epochs and newest measure
+    result = []
+    db = storage.get_connection()
+    for res in db.execute('SELECT name, epoch, last_seq, max(last_seen), sum(batches), sum(rows), count(*) FROM sync_node GROUP BY name ORDER BY name'):
+        newest = db.execute('SELECT max(m.ts) FROM sensor s JOIN measure m ON m.sensor_id = s.id WHERE s.name >= ? AND s.name < ?', (res[0] + '/', res[0] + '0')).fetchone()[0]
+        result.append({'node': res[0], 'epoch': res[1], 'last_seq': res[2], 'last_seen': res[3], 'batches': res[4], 'rows': res[5], 'epochs': res[6], 'newest_measure': newest})
+    return {'nodes': result}
+
+@app.route('/api/series')
+def api_series():
+
+    # same as the app's /api/series with ?node=zone1; without node the sensors need the node: sensors=zone1/moist,zone2/moist
+    node = request.args.get('node', '')
+    if node != '' and not NODE_NAME.match(node):
+        return Response('Invalid node name', status=400)
+    sensors = [x for x in request.args.get('sensors', 'moist,temp,humid,irrigation').split(',') if x != '']
+    try:
+        start_dt = datetime.fromtimestamp(int(request.args['start']) / 1000) if request.args.get('start', '').isdigit() else None
+        end_dt = datetime.fromtimestamp(int(request.args['end']) / 1000) if request.args.get('end', '').isdigit() else None
+        points = int(request.args.get('points', 0))
+    except ValueError:
+        return Response('Invalid start, end or points', status=400)
+    if start_dt is None:
+        start_dt = datetime.now() - timedelta(days=7, minutes=30)
+
+    resolution = request.args.get('resolution', 'auto')
+    if resolution == 'auto':
+        resolution = rollup.pick_resolution(start_dt, end_dt or datetime.now())
+    elif resolution != 'raw' and resolution not in rollup.ROLLUP_TABLES:
+        return Response('Invalid resolution', status=400)
+
+    def generate():
+        cur = storage.get_connection().cursor()
+        for part in series.stream(cur, sensors, start_dt, end_dt, resolution, points, node + '/' if node != '' else ''):
+            yield part
+        cur.close()
+
+    response = Response(generate(), mimetype='application/json')
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def main(args):
+
+    parser = argparse.ArgumentParser(description='Collect measures and irrigation logs of all Pis')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--database', default=storage.DATABASE)
+    args = parser.parse_args(args)
+
+    storage.DATABASE = args.database
+    init_db(args.database)
+    app.run(host=args.host, port=args.port, threaded=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,128 @@
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+
+import storage
+
+# Migrates a database with the old measure_val (sensor TEXT, dt TEXT, val REAL) layout to the compact
+# measure/sensor tables in place and reports size and read speed before and after.
+# The app does the same migration at startup (storage.migrate_3), this tool adds the VACUUM to give the
+# space back and the report. Use --copy to only report on a copy and leave the database untouched.
+#
+#   python3 compact_schema.py [--copy] [path to database]
+
+def db_size(db):
+    page_size = db.execute('PRAGMA page_size').fetchone()[0]
+    return db.execute('PRAGMA page_count').fetchone()[0] * page_size
+
+def table_size(db, name):
+    # needs the dbstat virtual table, not available in every sqlite build
+    try:
+        res = db.execute('SELECT sum(pgsize) FROM dbstat WHERE name = ? OR name IN (SELECT name FROM sqlite_master WHERE tbl_name = ? AND type = \'index\')', (name, name)).fetchone()
+        return res[0] or 0
+    except sqlite3.OperationalError:
+        return None
+
+def best_of(func, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        rows = func()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best, rows
+
+def read_old(db, start_dt):
+    # what the chart did: select the rows of one sensor and parse every dt
+    rows = 0
+    for sensor in storage.SENSORS:
+        for res in db.execute('SELECT dt, val FROM measure_val WHERE sensor = ? AND dt >= ? ORDER BY dt', (sensor, start_dt)):
+            int(datetime.fromisoformat(res[0]).timestamp()) * 1000
+            rows = rows + 1
+    return rows
+
+def read_new(db, start_dt):
+    rows = 0
+    for sensor in storage.SENSORS:
+        for res in db.execute('SELECT m.ts, m.val FROM measure m JOIN sensor s ON s.id = m.sensor_id WHERE s.name = ? AND m.ts >= ? ORDER BY m.ts', (sensor, int(start_dt.timestamp()))):
+            res[0] * 1000
+            rows = rows + 1
+    return rows
+
+def report_line(label, before, after, unit):
+    if before is None or after is None:
+        print('{:<28} {:>12} {:>12}'.format(label, '-' if before is None else before, '-' if after is None else after))
+        return
+    change = ''
+    if before > 0:
+        change = '{:+.0f}%'.format((after - before) / before * 100)
+    print('{:<28} {:>12} {:>12} {:>8}'.format(label, unit(before), unit(after), change))
+
+def main(args):
+
+    use_copy = '--copy' in args
+    args = [a for a in args if a != '--copy']
+    path = args[0] if len(args) > 0 else storage.DATABASE
+
+    if use_copy:
+        tmp_dir = tempfile.mkdtemp()
+        copy_path = os.path.join(tmp_dir, 'database.db')
+        src = sqlite3.connect(path)
+        dst = sqlite3.connect(copy_path)
+        src.backup(dst)
+        src.close()
+        dst.close()
+        path = copy_path
+
+    db = sqlite3.connect(path)
+    if db.execute('SELECT name FROM sqlite_master WHERE type = \'table\' AND name = \'measure_val\'').fetchone() is None:
+        print('Database is not in the old measure_val layout (already migrated?)')
+        db.close()
+        return 1
+
+    start_dt = datetime.now() - timedelta(days=7, minutes=30)
+    rows_before = db.execute('SELECT count(*) FROM measure_val').fetchone()[0]
+    size_before = db_size(db)
+    table_before = table_size(db, 'measure_val')
+    read_7d_before, read_rows = best_of(lambda: read_old(db, start_dt))
+    read_all_before, _ = best_of(lambda: read_old(db, datetime(2000, 1, 1)), 1)
+    db.close()
+
+    print('Migrating', rows_before, 'rows')
+    start = time.perf_counter()
+    storage.init_schema(path)
+    migrate_time = time.perf_counter() - start
+
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    db.execute('VACUUM')
+    rows_after = db.execute('SELECT count(*) FROM measure').fetchone()[0]
+    size_after = db_size(db)
+    table_after = table_size(db, 'measure')
+    read_7d_after, _ = best_of(lambda: read_new(db, start_dt))
+    read_all_after, _ = best_of(lambda: read_new(db, datetime(2000, 1, 1)), 1)
+    db.close()
+
+    kb = lambda x: '{:.0f} kB'.format(x / 1024)
+    ms = lambda x: '{:.1f} ms'.format(x * 1000)
+
+    print('Migration took {:.1f} s, {} rows ({} duplicates within the same second merged)'.format(migrate_time, rows_after, rows_before - rows_after))
+    print('{:<28} {:>12} {:>12} {:>8}'.format('', 'before', 'after', 'change'))
+    report_line('database size (incl. rollups)', size_before, size_after, kb)
+    report_line('measures table + indexes', table_before, table_after, kb)
+    if rows_before > 0 and rows_after > 0:
+        report_line('bytes per row', size_before // rows_before, size_after // rows_after, str)
+    report_line('read 7 days (' + str(read_rows) + ' rows)', read_7d_before, read_7d_after, ms)
+    report_line('read all rows', read_all_before, read_all_after, ms)
+
+    if use_copy:
+        shutil.rmtree(os.path.dirname(path))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
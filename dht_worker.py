@@ -0,0 +1,119 @@
+import os
+import sys
+import time
+import select
+import threading
+import subprocess
+
+# Long running DHT22 worker process
+# Reading the DHT22 through libgpiod can hang on 100% CPU, that's why it never ran inside the web app itself.
+# Instead of starting a new python process for every sample (dhtsensor_standalone.py) this worker keeps the
+# device open and answers read requests over a pipe: write 'read' + newline, get back 'temp|humid' (0|0 on error).
+# DHTWorker is the side used by the app: it applies a timeout per read and kills/restarts a hanging worker.
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dht_worker.py')
+
+class DHTWorker:
+
+    def __init__(self, python='/usr/bin/python3', read_timeout=5):
+        self.python = python
+        self.read_timeout = read_timeout
+        self.proc = None
+        self.lock = threading.Lock()
+
+        # counters, see stats()
+        self.reads = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.restarts = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_last = 0.0
+
+    def start(self):
+        if self.proc is not None and self.proc.poll() is None:
+            return
+        if self.proc is not None:
+            self.restarts = self.restarts + 1
+        self.proc = subprocess.Popen([self.python, WORKER_SCRIPT], stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+
+    def stop(self):
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc = None
+
+    def read(self):
+        # returns 'temp|humid' like dhtsensor_standalone.py did, or an empty string if the worker didn't answer in time
+        with self.lock:
+            self.reads = self.reads + 1
+            start = time.monotonic()
+            output = ''
+            try:
+                self.start()
+                self.proc.stdin.write(b'read\n')
+                ready, _, _ = select.select([self.proc.stdout], [], [], self.read_timeout)
+                if ready:
+                    output = self.proc.stdout.readline().decode().rstrip()
+                else:
+                    # worker hangs (libgpiod), kill it so next read starts a fresh one
+                    print('DHT22 worker did not respond within', self.read_timeout, 'seconds, restarting')
+                    self.timeouts = self.timeouts + 1
+                    self.stop()
+                    self.restarts = self.restarts + 1
+            except (OSError, ValueError) as error:
+                print('DHT22 worker failed:', error)
+                self.stop()
+                self.restarts = self.restarts + 1
+
+            if output == '' or output == '0|0':
+                self.failures = self.failures + 1
+
+            latency = time.monotonic() - start
+            self.latency_last = latency
+            self.latency_total = self.latency_total + latency
+            self.latency_max = max(self.latency_max, latency)
+
+        return output
+
+    def stats(self):
+        return {
+            'reads': self.reads,
+            'failures': self.failures,
+            'timeouts': self.timeouts,
+            'restarts': self.restarts,
+            'failure_rate': round(self.failures / self.reads, 3) if self.reads > 0 else 0,
+            'latency_avg': round(self.latency_total / self.reads, 3) if self.reads > 0 else 0,
+            'latency_max': round(self.latency_max, 3),
+            'latency_last': round(self.latency_last, 3),
+        }
+
+def worker_main():
+
+    import board
+    import adafruit_dht
+
+    # Initial the dht device, with data pin connected to:
+    dhtDevice = adafruit_dht.DHT22(board.D24)  # pin 18 / GPIO 24
+
+    for line in sys.stdin:
+        if line.strip() != 'read':
+            continue
+        try:
+            temperature_c = dhtDevice.temperature
+            humidity = dhtDevice.humidity
+            output = "{:.1f}|{}".format(temperature_c, humidity)
+        except (RuntimeError, TypeError):
+            # Errors happen fairly often, DHT's are hard to read, just keep going (TypeError when no value was read)
+            output = "0|0"
+        sys.stdout.write(output + '\n')
+        sys.stdout.flush()
+
+    dhtDevice.exit()
+
+if __name__ == '__main__':
+    worker_main()
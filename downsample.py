@@ -0,0 +1,103 @@
+import bisect
+
+# Largest-Triangle-Three-Buckets downsampling of chart series (Steinarsson, 2013)
+# Keeps the visual shape of a series with a fixed number of points: per bucket the point is kept that forms
+# the largest triangle with the previously kept point and the average of the next bucket, so peaks and
+# drops survive where a plain average or every n-th point would flatten them.
+# Pinned points (e.g. the readings around an irrigation event) are kept and count against the point budget: the
+# series is split at these points and every part gets its share of what is left. When there are more pins than
+# the budget allows, only one pin per bucket of readings is kept, so the budget always holds.
+
+def lttb(t, v, threshold):
+
+    # returns the indexes of the points to keep, first and last are always kept
+    n = len(t)
+    if threshold >= n or n <= 2:
+        return list(range(n))
+    if threshold <= 2:
+        return [0, n - 1]
+
+    keep = [0]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+
+        # average point of the next bucket (the last point for the last bucket)
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        if next_start >= n - 1:
+            avg_t = t[n - 1]
+            avg_v = v[n - 1]
+        else:
+            count = next_end - next_start
+            avg_t = sum(t[next_start:next_end]) / count
+            avg_v = sum(v[next_start:next_end]) / count
+
+        # point of this bucket with the largest triangle
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        at = t[a]
+        av = v[a]
+        max_area = -1
+        max_index = start
+        for j in range(start, end):
+            area = abs((at - avg_t) * (v[j] - av) - (at - t[j]) * (avg_v - av))
+            if area > max_area:
+                max_area = area
+                max_index = j
+
+        keep.append(max_index)
+        a = max_index
+
+    keep.append(n - 1)
+    return keep
+
+def pinned_indexes(t, times):
+
+    # last point at or before and first point after every pinned time (t sorted asc)
+    pinned = set()
+    for pin in times:
+        i = bisect.bisect_right(t, pin)
+        if i > 0:
+            pinned.add(i - 1)
+        if i < len(t):
+            pinned.add(i)
+    return sorted(pinned)
+
+def downsample(t, v, points, pin_times=()):
+
+    # returns (t, v) with at most `points` points, pinned points count against the budget
+    n = len(t)
+    if points <= 0 or n <= points:
+        return t, v
+    if points < 2:
+        points = 2
+
+    # split at the pinned points; with more pins than the budget allows, only the first pin of every bucket of
+    # (n - 2) / (points - 2) readings is kept
+    pins = [i for i in pinned_indexes(t, pin_times) if 0 < i < n - 1]
+    if len(pins) > points - 2:
+        buckets = {}
+        for i in pins:
+            buckets.setdefault((i - 1) * (points - 2) // (n - 2), i)
+        pins = sorted(buckets.values())
+    bounds = [0] + pins + [n - 1]
+
+    # what is left of the budget goes to the parts by length (largest remainder), each part keeps its end points
+    left = points - len(bounds)
+    inner = [bounds[k + 1] - bounds[k] - 1 for k in range(len(bounds) - 1)]
+    total = sum(inner)
+    shares = [left * x // total if total > 0 else 0 for x in inner]
+    rest = sorted(range(len(inner)), key=lambda k: left * inner[k] % total if total > 0 else 0, reverse=True)
+    for k in rest[:left - sum(shares)]:
+        shares[k] = shares[k] + 1
+
+    keep = [0]
+    for k in range(len(bounds) - 1):
+        start = bounds[k]
+        end = bounds[k + 1]
+        part = [start + i for i in lttb(t[start:end + 1], v[start:end + 1], min(shares[k], inner[k]) + 2)]
+        # part starts with the end point of the previous part
+        keep.extend(part[1:])
+
+    return [t[i] for i in keep], [v[i] for i in keep]
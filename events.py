@@ -0,0 +1,74 @@
+import json
+import queue
+import threading
+from collections import deque
+
+# Live events (new measures, valve switches) pushed to the pages as Server-Sent Events
+# Every event gets an increasing id and the last events are kept, so a browser that reconnects with
+# Last-Event-ID gets what it missed instead of reloading the full history. Every subscriber has its own
+# bounded queue: a client that doesn't keep up is disconnected and catches up on reconnect.
+
+class EventBroker:
+
+    def __init__(self, keep=100, max_subscribers=20, queue_size=50):
+        self.lock = threading.Lock()
+        self.recent = deque(maxlen=keep)
+        self.subscribers = []
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self.last_id = 0
+
+    def publish(self, event, data):
+        with self.lock:
+            self.last_id = self.last_id + 1
+            message = (self.last_id, event, json.dumps(data, separators=(',', ':')))
+            self.recent.append(message)
+            for q in list(self.subscribers):
+                try:
+                    q.put_nowait(message)
+                except queue.Full:
+                    # slow client, end its stream (None) and let it reconnect
+                    self.subscribers.remove(q)
+                    q.queue.clear()
+                    q.put_nowait(None)
+
+    def subscribe(self, last_event_id=None):
+        # returns a queue with the events after last_event_id (if still kept) and all new events, None when full
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                return None
+            q = queue.Queue(self.queue_size)
+            if last_event_id is not None and last_event_id <= self.last_id:
+                for message in self.recent:
+                    if message[0] > last_event_id and not q.full():
+                        q.put_nowait(message)
+            self.subscribers.append(q)
+            return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            if q in self.subscribers:
+                self.subscribers.remove(q)
+
+    def stream(self, q, keepalive=15):
+        # text/event-stream of the messages of q, a comment line every keepalive seconds keeps proxies from closing it
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    message = q.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if message is None:
+                    return
+                yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(*message)
+        finally:
+            self.unsubscribe(q)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'subscribers': len(self.subscribers),
+                'last_id': self.last_id,
+            }
@@ -0,0 +1,152 @@
+import io
+import sys
+import csv
+import zlib
+import argparse
+from datetime import datetime
+
+import storage
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Bulk export of the history as CSV or Arrow IPC stream (columnar, read with pyarrow/pandas/polars/duckdb)
+# Rows are read with fetchmany() in chunks and every chunk is encoded and handed out before the next one is
+# read, so memory stays the same for any range. Used by the /export routes and on the command line:
+#
+#   python3 export.py measures --format arrow --sensors moist,temp --start 2026-01-01 --gzip -o measures.arrow.gz [path to database]
+#
+# Arrow needs pyarrow (not required by the app itself).
+
+CHUNK_ROWS = 5000
+
+TABLES = ['measures', 'irrigation']
+FORMATS = ['csv', 'arrow']
+
+COLUMNS = {
+    'measures': ['ts', 'sensor', 'val'],
+    'irrigation': ['valve', 'dt', 'status', 'source', 'control_type'],
+}
+
+def arrow_schema(table):
+    if table == 'measures':
+        return pa.schema([('ts', pa.timestamp('s')), ('sensor', pa.string()), ('val', pa.float64())])
+    return pa.schema([(name, pa.string()) for name in COLUMNS[table]])
+
+def query_chunks(cur, table, sensors, start_dt, end_dt, chunk_rows=CHUNK_ROWS):
+
+    # yields lists of rows, end_dt None means no upper bound
+    names = None
+    if table == 'measures':
+        # by sensor and ts: the primary key order, so SQLite doesn't have to sort (and buffer) the whole range
+        names = {res[0]: res[1] for res in cur.execute('SELECT id, name FROM sensor')}
+        ids = [i for i in names if names[i] in sensors]
+        marks = ','.join(['?'] * len(ids))
+        cur.execute('SELECT ts, sensor_id, val FROM measure WHERE sensor_id IN (' + marks + ') AND ts >= ? AND ts <= ? ORDER BY sensor_id, ts',
+            ids + [int(start_dt.timestamp()) if start_dt is not None else 0, int(end_dt.timestamp()) if end_dt is not None else 2 ** 62])
+    else:
+        # dt is stored as text, str(datetime) compares in the same order
+        cur.execute('SELECT valve, dt, status, source, control_type FROM irrigation_log WHERE dt >= ? AND dt <= ? ORDER BY dt',
+            (str(start_dt) if start_dt is not None else '', str(end_dt) if end_dt is not None else '9999'))
+
+    while True:
+        rows = cur.fetchmany(chunk_rows)
+        if len(rows) == 0:
+            break
+        if names is not None:
+            rows = [(res[0], names[res[1]], res[2]) for res in rows]
+        yield rows
+
+def encode_csv(table, chunks):
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(COLUMNS[table])
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode()
+
+def encode_arrow(table, chunks):
+
+    # one record batch per chunk, the stream writer writes the schema first and an end marker on close
+    schema = arrow_schema(table)
+    sink = io.BytesIO()
+    writer = pa.ipc.new_stream(sink, schema)
+    for rows in chunks:
+        columns = list(zip(*rows))
+        writer.write_batch(pa.record_batch([pa.array(columns[i], type=schema.field(i).type) for i in range(len(columns))], schema=schema))
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    writer.close()
+    yield sink.getvalue()
+
+def gzip_stream(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for block in data:
+        block = compressor.compress(block)
+        if len(block) > 0:
+            yield block
+    yield compressor.flush()
+
+def export(cur, table, fmt, sensors=None, start_dt=None, end_dt=None, compress=False):
+
+    # generator of bytes
+    chunks = query_chunks(cur, table, sensors or storage.SENSORS, start_dt, end_dt)
+    if fmt == 'arrow':
+        data = encode_arrow(table, chunks)
+    else:
+        data = encode_csv(table, chunks)
+    if compress:
+        data = gzip_stream(data)
+    return data
+
+def file_name(table, fmt, compress):
+    return 'irrigation-' + table + '.' + fmt + ('.gz' if compress else '')
+
+def parse_dt(value):
+    if value is None:
+        return None
+    return datetime.fromisoformat(value)
+
+def main(args):
+
+    parser = argparse.ArgumentParser(description='Export measures or the irrigation log as CSV or Arrow')
+    parser.add_argument('table', choices=TABLES)
+    parser.add_argument('database', nargs='?', default=storage.DATABASE)
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--sensors', default=','.join(storage.SENSORS), help='measures only')
+    parser.add_argument('--start', help='ISO date/time, default all history')
+    parser.add_argument('--end', help='ISO date/time, default now')
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('-o', '--output', help='file, default stdout')
+    args = parser.parse_args(args)
+
+    if args.format == 'arrow' and pa is None:
+        print('Arrow export needs pyarrow (pip3 install pyarrow)')
+        return 1
+
+    db = storage.connect(args.database)
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    size = 0
+    try:
+        for block in export(db.cursor(), args.table, args.format, [x for x in args.sensors.split(',') if x != ''],
+                parse_dt(args.start), parse_dt(args.end), args.gzip):
+            out.write(block)
+            size = size + len(block)
+    finally:
+        if args.output:
+            out.close()
+        db.close()
+
+    if args.output:
+        print('{} written, {:.1f} kB'.format(args.output, size / 1024))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
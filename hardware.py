@@ -0,0 +1,247 @@
+import os
+import math
+import time
+import random
+import threading
+
+# Hardware abstraction: relay outputs (valve, sensor power), ADC (MCP3008), DHT22 and the CPU temperature
+# Backends only load their drivers when a component is first used, so importing the app is cheap and works
+# off-Pi. HARDWARE=sim selects the simulator which behaves deterministically (SIM_SEED) and can add latency
+# (SIM_LATENCY, multiplier of the typical Pi timings) and failures (SIM_FAILURE_RATE, 0..1) for load tests.
+# The MCP3008 is read over hardware SPI (spidev) when it's enabled, otherwise over software (bit-banged) SPI;
+# ADC_SPI=hardware or software forces one of them. read_adc_burst() takes many readings in one go for oversampling.
+
+class PiBackend:
+
+    # Software SPI configuration:
+    # MCP3008 CLK   to Pi pin 18    > GPIO 11 (23)
+    # MCP3008 DOUT  to Pi pin 23    > GPIO 09 (21)
+    # MCP3008 DIN   to Pi pin 24    > GPIO 10 (19)
+    # MCP3008 CS/SHDN to Pi pin 25  > GPIO 08 (24)
+    CLK  = 11
+    MISO = 9
+    MOSI = 10
+    CS   = 8
+
+    # Hardware SPI uses the same pins (SPI0: SCLK GPIO 11, MISO 9, MOSI 10, CE0 8), enable it with raspi-config
+    SPI_PORT = 0
+    SPI_DEVICE = 0
+    # MCP3008 is rated 1.35 MHz at 2.7 V
+    SPI_SPEED = 1000000
+
+    def __init__(self, adc_spi='auto'):
+        self.lock = threading.Lock()
+        self.adc_lock = threading.Lock()
+        self.adc_spi = adc_spi
+        self.adc_mode = None
+        self.gpio = None
+        self.mcp = None
+        self.cpu = None
+        self.dht_worker = None
+
+    def get_gpio(self):
+        with self.lock:
+            if self.gpio is None:
+                import RPi.GPIO as GPIO
+                GPIO.setmode(GPIO.BCM)
+                self.gpio = GPIO
+        return self.gpio
+
+    def setup_relay(self, channel):
+        GPIO = self.get_gpio()
+        GPIO.setup(channel, GPIO.OUT)
+        self.relay(channel, False)
+
+    def relay(self, channel, on):
+        # relay board switches on a low signal
+        GPIO = self.get_gpio()
+        GPIO.output(channel, GPIO.LOW if on else GPIO.HIGH)
+
+    def get_mcp(self):
+        with self.lock:
+            if self.mcp is None:
+                import Adafruit_MCP3008
+                if self.adc_spi in ('auto', 'hardware'):
+                    try:
+                        import Adafruit_GPIO.SPI as SPI
+                        self.mcp = Adafruit_MCP3008.MCP3008(spi=SPI.SpiDev(self.SPI_PORT, self.SPI_DEVICE, max_speed_hz=self.SPI_SPEED))
+                        self.adc_mode = 'hardware'
+                    except (ImportError, IOError) as error:
+                        # /dev/spidev0.0 missing: SPI not enabled (or no spidev module)
+                        if self.adc_spi == 'hardware':
+                            raise
+                        print('Hardware SPI not available, using software SPI:', error)
+                if self.mcp is None:
+                    self.mcp = Adafruit_MCP3008.MCP3008(clk=self.CLK, cs=self.CS, miso=self.MISO, mosi=self.MOSI)
+                    self.adc_mode = 'software'
+        return self.mcp
+
+    def read_adc(self, channel):
+        mcp = self.get_mcp()
+        with self.adc_lock:
+            return mcp.read_adc(channel)
+
+    def read_adc_burst(self, channels, samples):
+        # {channel: [samples readings]}, channels interleaved, as fast as the bus allows
+        mcp = self.get_mcp()
+        readings = {channel: [] for channel in channels}
+        with self.adc_lock:
+            for i in range(samples):
+                for channel in channels:
+                    readings[channel].append(mcp.read_adc(channel))
+        return readings
+
+    def read_dht(self):
+        # 'temp|humid', '0|0' on a failed reading or empty when the sensor didn't respond
+        with self.lock:
+            if self.dht_worker is None:
+                from dht_worker import DHTWorker
+                # This causes libgpiod_pulsei to hang on 100% CPU > separate worker process which is restarted when it hangs
+                self.dht_worker = DHTWorker()
+        return self.dht_worker.read()
+
+    def cpu_temperature(self):
+        with self.lock:
+            if self.cpu is None:
+                from gpiozero import CPUTemperature
+                self.cpu = CPUTemperature()
+        return self.cpu.temperature
+
+    def sensor_stats(self):
+        if self.dht_worker is None:
+            return {}
+        return self.dht_worker.stats()
+
+    def close(self):
+        if self.dht_worker is not None:
+            self.dht_worker.stop()
+
+class SimBackend:
+
+    # typical duration of each operation on a Pi in seconds
+    LATENCY = {
+        'relay': 0.001,
+        'adc': 0.002,
+        'adc_burst': 0.00003,
+        'dht': 0.3,
+        'cpu': 0.005,
+    }
+
+    # simulated time instead of the wall clock, so a seed always gives the same readings: the day advances with
+    # the DHT reads (3 per measurement, a measurement every 30 minutes) and after watering the soil stays wet
+    # for the ADC samples of 6 hours of measurements (32 per measurement, a burst counts as one sample)
+    DHT_READS_PER_DAY = 3 * 48
+    WET_SAMPLES = 32 * 12
+
+    def __init__(self, seed=0, latency=1.0, failure_rate=0.0, valve_channel=5):
+        self.latency = latency
+        self.valve_channel = valve_channel
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        # one generator per component so parallel sampling threads don't change each others sequence
+        self.rng = {}
+        for i, name in enumerate(['adc', 'dht', 'cpu']):
+            self.rng[name] = random.Random(seed * 10 + i)
+        self.relays = {}
+        self.wet_samples = 0
+        self.adc_mode = 'sim'
+        self.reads = 0
+        self.failures = 0
+
+    def wait(self, name):
+        if self.latency > 0:
+            time.sleep(self.LATENCY[name] * self.latency)
+
+    def fails(self, name):
+        return self.failure_rate > 0 and self.rng[name].random() < self.failure_rate
+
+    def setup_relay(self, channel):
+        self.relay(channel, False)
+
+    def relay(self, channel, on):
+        self.wait('relay')
+        with self.lock:
+            self.relays[channel] = on
+            if on and channel == self.valve_channel:
+                # watering: soil stays wet for a while after the valve was opened
+                self.wet_samples = self.WET_SAMPLES
+
+    def day_phase(self, reads):
+        # -1 at 3 am, peaks at 3 pm; the first read is at midnight
+        minutes = reads * 24 * 60 / self.DHT_READS_PER_DAY
+        return math.sin((minutes - 9 * 60) / (24 * 60) * 2 * math.pi)
+
+    def soil_level(self):
+        # capacitive sensor: lower value is wetter
+        with self.lock:
+            if self.wet_samples > 0:
+                self.wet_samples = self.wet_samples - 1
+                return 400
+        return 470
+
+    def read_adc(self, channel):
+        self.wait('adc')
+        if self.fails('adc'):
+            raise RuntimeError('Simulated ADC failure')
+        return self.adc_value(self.soil_level())
+
+    def adc_value(self, level):
+        return int(level + self.rng['adc'].gauss(0, 6))
+
+    def read_adc_burst(self, channels, samples):
+        # hardware SPI timing: one transfer per reading without the software SPI overhead
+        if self.latency > 0:
+            time.sleep(self.LATENCY['adc_burst'] * self.latency * samples * len(channels))
+        if self.fails('adc'):
+            raise RuntimeError('Simulated ADC failure')
+        level = self.soil_level()
+        return {channel: [self.adc_value(level) for i in range(samples)] for channel in channels}
+
+    def read_dht(self):
+        self.wait('dht')
+        with self.lock:
+            self.reads = self.reads + 1
+            reads = self.reads - 1
+        if self.fails('dht'):
+            with self.lock:
+                self.failures = self.failures + 1
+            return '0|0'
+        rng = self.rng['dht']
+        temperature_c = 20 + 6 * self.day_phase(reads) + rng.gauss(0, 0.3)
+        humidity = 60 - 15 * self.day_phase(reads) + rng.gauss(0, 1)
+        return "{:.1f}|{:.1f}".format(temperature_c, humidity)
+
+    def cpu_temperature(self):
+        self.wait('cpu')
+        if self.fails('cpu'):
+            raise RuntimeError('Simulated CPU temperature failure')
+        return round(45 + self.rng['cpu'].gauss(0, 0.5), 1)
+
+    def sensor_stats(self):
+        return {
+            'reads': self.reads,
+            'failures': self.failures,
+            'failure_rate': round(self.failures / self.reads, 3) if self.reads > 0 else 0,
+        }
+
+    def close(self):
+        pass
+
+backend = None
+
+def get_backend():
+
+    global backend
+    if backend is None:
+        if os.environ.get('HARDWARE', 'pi') == 'sim':
+            backend = SimBackend(int(os.environ.get('SIM_SEED', 0)), float(os.environ.get('SIM_LATENCY', 1.0)), float(os.environ.get('SIM_FAILURE_RATE', 0)))
+        else:
+            backend = PiBackend(os.environ.get('ADC_SPI', 'auto'))
+    return backend
+
+def set_backend(new_backend):
+
+    # e.g. a SimBackend with specific settings in benchmarks
+    global backend
+    backend = new_backend
+    return backend
@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+# irrigation_cycle: one row per irrigation cycle, maintained on every valve state change in water_control()
+# All ON/OFF pulses of a valve that start within an hour of the first pulse belong to the same cycle.
+# last_on holds the dt of an ON that has no OFF yet; the pulse is added to the totals when the OFF comes in.
+
+CYCLE_WINDOW = timedelta(hours=1)
+ML_PER_SECOND = 1 # best guess, amount is ~1ml per second with 2bar water pressure (regulated)
+
+def init_cycle_table(cur):
+
+    cur.execute('CREATE TABLE IF NOT EXISTS irrigation_cycle (valve TEXT, dt_start TEXT, dt_end TEXT, pulses INTEGER, total_seconds REAL, total_ml INTEGER, is_test INTEGER, last_on TEXT)')
+    cur.execute('CREATE INDEX IF NOT EXISTS irrigation_cycle_dt_start ON irrigation_cycle (dt_start)')
+    cur.execute('CREATE INDEX IF NOT EXISTS irrigation_cycle_valve_dt_start ON irrigation_cycle (valve, dt_start)')
+
+def record_event(cur, valve, dt, status, is_test=False):
+
+    if status == 'status_on':
+        res = cur.execute('SELECT rowid FROM irrigation_cycle WHERE valve = ? AND dt_start >= ? ORDER BY dt_start DESC LIMIT 1',
+            (valve, dt - CYCLE_WINDOW)).fetchone()
+        if res is not None:
+            # another pulse in the current cycle
+            cur.execute('UPDATE irrigation_cycle SET last_on = ?, dt_end = ? WHERE rowid = ?', (dt, dt, res[0]))
+        else:
+            cur.execute('INSERT INTO irrigation_cycle (valve, dt_start, dt_end, pulses, total_seconds, total_ml, is_test, last_on) VALUES (?, ?, ?, 0, 0, 0, ?, ?)',
+                (valve, dt, dt, 1 if is_test else 0, dt))
+
+    elif status == 'status_off':
+        res = cur.execute('SELECT rowid, last_on, total_seconds FROM irrigation_cycle WHERE valve = ? ORDER BY dt_start DESC LIMIT 1', (valve, )).fetchone()
+        if res is None or res[1] is None:
+            # OFF without an ON (e.g. valve switched off twice), nothing to add
+            return
+        total_seconds = res[2] + (dt - datetime.fromisoformat(res[1])).total_seconds()
+        cur.execute('UPDATE irrigation_cycle SET pulses = pulses + 1, total_seconds = ?, total_ml = ?, dt_end = ?, last_on = NULL WHERE rowid = ?',
+            (total_seconds, int(round(ML_PER_SECOND * total_seconds)), dt, res[0]))
+
+def rebuild_cycles(cur):
+
+    # one-off backfill from irrigation_log: replay all state changes in order
+    cur.execute('DELETE FROM irrigation_cycle')
+    events = cur.execute('SELECT valve, dt, status, control_type FROM irrigation_log ORDER BY dt ASC').fetchall()
+    for res in events:
+        record_event(cur, res[0], datetime.fromisoformat(res[1]), res[2], 'Test' in str(res[3]))
+    return len(events)
+
+def query_cycles(cur, start_dt):
+
+    # completed pulses only, in asc order: (valve, dt_start, dt_end, pulses, total_seconds, total_ml, is_test)
+    return cur.execute('SELECT valve, dt_start, dt_end, pulses, total_seconds, total_ml, is_test FROM irrigation_cycle WHERE dt_start >= ? AND pulses > 0 ORDER BY dt_start ASC',
+        (start_dt, )).fetchall()
+
+if __name__ == '__main__':
+
+    # one-off backfill: python3 irrigation_cycle.py [path to database]
+    import sys
+    import sqlite3
+
+    db = sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else 'db/database.db')
+    cur = db.cursor()
+    init_cycle_table(cur)
+    count = rebuild_cycles(cur)
+    db.commit()
+    db.close()
+    print('Rebuilt irrigation cycles from', count, 'log entries')
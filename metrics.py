@@ -0,0 +1,114 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# Timing histograms and counters for the hot paths, rendered in the Prometheus text format at /metrics
+# timer() and record() also add the duration to the profile of the current thread when one was started with
+# start_profile(), which the app uses for the per-request Server-Timing header.
+
+# seconds, from fast ADC reads up to a full measurement
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# histograms that don't hold durations (e.g. batch sizes) get their own buckets
+buckets = {}
+
+lock = threading.Lock()
+histograms = {}
+counters = {}
+help_texts = {}
+local = threading.local()
+
+def describe(name, text, bounds=None):
+    help_texts[name] = text
+    if bounds is not None:
+        buckets[name] = bounds
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def observe(name, value, **labels):
+
+    key = label_key(labels)
+    bounds = buckets.get(name, BUCKETS)
+    with lock:
+        series = histograms.setdefault(name, {})
+        h = series.get(key)
+        if h is None:
+            h = series[key] = {'buckets': [0] * len(bounds), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(bounds):
+            if value <= bound:
+                h['buckets'][i] = h['buckets'][i] + 1
+        h['sum'] = h['sum'] + value
+        h['count'] = h['count'] + 1
+
+def inc(name, amount=1, **labels):
+
+    key = label_key(labels)
+    with lock:
+        series = counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + amount
+
+def record(name, duration, **labels):
+
+    # observe a duration and add it to the profile of this thread (if any)
+    observe(name, duration, **labels)
+    profile = getattr(local, 'profile', None)
+    if profile is not None:
+        profile[name] = profile.get(name, 0) + duration
+
+@contextmanager
+def timer(name, **labels):
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start, **labels)
+
+def start_profile():
+    local.profile = {}
+
+def stop_profile():
+    profile = getattr(local, 'profile', None)
+    local.profile = None
+    return profile
+
+def format_labels(key, extra=None):
+    items = list(key)
+    if extra is not None:
+        items.append(extra)
+    if len(items) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) + '}'
+
+def format_bound(bound):
+    return ('%f' % bound).rstrip('0').rstrip('.')
+
+def render(gauges=None):
+
+    # gauges: {name: value} of values read at scrape time (e.g. the DHT worker counters)
+    lines = []
+    with lock:
+        for name in sorted(counters):
+            if name in help_texts:
+                lines.append('# HELP ' + name + ' ' + help_texts[name])
+            lines.append('# TYPE ' + name + ' counter')
+            for key, value in sorted(counters[name].items()):
+                lines.append(name + format_labels(key) + ' ' + str(value))
+
+        for name in sorted(histograms):
+            if name in help_texts:
+                lines.append('# HELP ' + name + ' ' + help_texts[name])
+            lines.append('# TYPE ' + name + ' histogram')
+            for key, h in sorted(histograms[name].items()):
+                for i, bound in enumerate(buckets.get(name, BUCKETS)):
+                    lines.append(name + '_bucket' + format_labels(key, ('le', format_bound(bound))) + ' ' + str(h['buckets'][i]))
+                lines.append(name + '_bucket' + format_labels(key, ('le', '+Inf')) + ' ' + str(h['count']))
+                lines.append(name + '_sum' + format_labels(key) + ' ' + repr(h['sum']))
+                lines.append(name + '_count' + format_labels(key) + ' ' + str(h['count']))
+
+    for name, value in sorted((gauges or {}).items()):
+        lines.append('# TYPE ' + name + ' gauge')
+        lines.append(name + ' ' + str(value))
+
+    return '\n'.join(lines) + '\n'
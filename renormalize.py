@@ -0,0 +1,168 @@
+import sys
+import time
+import argparse
+from datetime import datetime
+
+import storage
+import rollup
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Batch re-normalisation of stored measures from the raw samples in measure_raw
+# All measurements in the range are processed in one vectorized pass: samples of all measurements are
+# concatenated in one array and every outlier rule works per measurement (group) with bincount/lexsort
+# instead of python loops. Needs numpy (not required by the app itself).
+#
+#   python3 renormalize.py --method mad --k 3 [--sensors moist] [--start 2020-01-01] [--end ...] [--apply] [path to database]
+#
+# Without --apply only the difference with the stored values is reported.
+
+def group_ids(counts):
+    return np.repeat(np.arange(len(counts)), counts)
+
+def group_starts(counts):
+    starts = np.zeros(len(counts), dtype=np.int64)
+    np.cumsum(counts[:-1], out=starts[1:])
+    return starts
+
+def sort_groups(values, ids):
+    # sort values within each group, groups stay in the same order
+    return values[np.lexsort((values, ids))]
+
+def group_median(sorted_values, starts, counts):
+    lo = starts + (counts - 1) // 2
+    hi = starts + counts // 2
+    return (sorted_values[lo] + sorted_values[hi]) / 2
+
+def masked_mean(values, keep, ids, counts):
+    # mean of the kept values per group, plain mean when nothing was kept
+    kept = np.bincount(ids, weights=keep, minlength=len(counts))
+    kept_sum = np.bincount(ids, weights=values * keep, minlength=len(counts))
+    plain = np.bincount(ids, weights=values, minlength=len(counts)) / counts
+    return np.where(kept > 0, kept_sum / np.maximum(kept, 1), plain)
+
+def sigma_clip(values, counts, k=1.0):
+    # keep samples within k standard deviations of the mean (k=1 is what normalize_average() does)
+    ids = group_ids(counts)
+    mean = np.bincount(ids, weights=values, minlength=len(counts)) / counts
+    sd = np.sqrt(np.bincount(ids, weights=(values - mean[ids]) ** 2, minlength=len(counts)) / counts)
+    # same comparison as normalize_average() so samples right on the boundary are treated the same
+    keep = (values >= (mean - k * sd)[ids]) & (values <= (mean + k * sd)[ids])
+    return masked_mean(values, keep, ids, counts)
+
+def median_mad(values, counts, k=3.0):
+    # keep samples within k scaled median absolute deviations of the median
+    ids = group_ids(counts)
+    starts = group_starts(counts)
+    median = group_median(sort_groups(values, ids), starts, counts)
+    dev = np.abs(values - median[ids])
+    mad = group_median(sort_groups(dev, ids), starts, counts) * 1.4826
+    keep = dev <= k * mad[ids]
+    return masked_mean(values, keep, ids, counts)
+
+def trimmed_mean(values, counts, k=0.1):
+    # drop the lowest and highest k (proportion) of the samples
+    ids = group_ids(counts)
+    starts = group_starts(counts)
+    sorted_values = sort_groups(values, ids)
+    rank = np.arange(len(values)) - starts[ids]
+    cut = np.floor(counts * k).astype(np.int64)
+    keep = (rank >= cut[ids]) & (rank < (counts - cut)[ids])
+    return masked_mean(sorted_values, keep, ids, counts)
+
+METHODS = {
+    'sigma': (sigma_clip, 1.0),
+    'mad': (median_mad, 3.0),
+    'trimmed': (trimmed_mean, 0.1),
+}
+
+def load_samples(cur, sensors, start_ts, end_ts):
+
+    # returns keys [(sensor_id, ts)], stored values, sample counts and all samples in one array
+    marks = ','.join(['?'] * len(sensors))
+    keys = []
+    stored = []
+    counts = []
+    blobs = []
+    for res in cur.execute('SELECT r.sensor_id, r.ts, r.samples, m.val FROM sensor s JOIN measure_raw r ON r.sensor_id = s.id '
+            'LEFT JOIN measure m ON m.sensor_id = r.sensor_id AND m.ts = r.ts '
+            'WHERE s.name IN (' + marks + ') AND r.ts >= ? AND r.ts <= ? ORDER BY r.sensor_id, r.ts', list(sensors) + [start_ts, end_ts]):
+        keys.append((res[0], res[1]))
+        counts.append(len(res[2]) // 4)
+        blobs.append(res[2])
+        stored.append(res[3] if res[3] is not None else np.nan)
+
+    values = np.frombuffer(b''.join(blobs), dtype=np.float32).astype(np.float64)
+    return keys, np.array(stored, dtype=np.float64), np.array(counts, dtype=np.int64), values
+
+def renormalize(cur, sensors, start_ts, end_ts, method, k=None):
+
+    func, default_k = METHODS[method]
+    keys, stored, counts, values = load_samples(cur, sensors, start_ts, end_ts)
+    if len(keys) == 0:
+        return keys, stored, np.array([]), 0
+    normalized = np.round(func(values, counts, default_k if k is None else k), 1)
+    return keys, stored, normalized, len(values)
+
+def apply(cur, keys, normalized):
+
+    cur.executemany('UPDATE measure SET val = ? WHERE sensor_id = ? AND ts = ?',
+        [(float(normalized[i]), keys[i][0], keys[i][1]) for i in range(len(keys))])
+    rollup.rebuild_rollups(cur)
+
+def parse_ts(value, default):
+    if value is None:
+        return default
+    return int(datetime.fromisoformat(value).timestamp())
+
+def main(args):
+
+    parser = argparse.ArgumentParser(description='Recompute stored measures from the raw samples with another outlier rule')
+    parser.add_argument('database', nargs='?', default=storage.DATABASE)
+    parser.add_argument('--method', choices=sorted(METHODS), default='sigma')
+    parser.add_argument('--k', type=float, help='sigma: number of standard deviations (1), mad: number of MADs (3), trimmed: proportion cut at each end (0.1)')
+    parser.add_argument('--sensors', default=','.join(storage.SENSORS))
+    parser.add_argument('--start', help='ISO date/time, default all history')
+    parser.add_argument('--end', help='ISO date/time, default now')
+    parser.add_argument('--apply', action='store_true', help='write the new values (and rebuild the rollups)')
+    args = parser.parse_args(args)
+
+    if np is None:
+        print('renormalize.py needs numpy (pip3 install numpy)')
+        return 1
+
+    storage.init_schema(args.database)
+    db = storage.connect(args.database)
+    cur = db.cursor()
+
+    start = time.perf_counter()
+    keys, stored, normalized, sample_count = renormalize(cur, [x for x in args.sensors.split(',') if x != ''],
+        parse_ts(args.start, 0), parse_ts(args.end, 2 ** 62), args.method, args.k)
+    duration = time.perf_counter() - start
+
+    print('{} measurements, {} samples processed in {:.3f} s'.format(len(keys), sample_count, duration))
+    if len(keys) > 0:
+        sensor_names = {res[0]: res[1] for res in cur.execute('SELECT id, name FROM sensor')}
+        sensor_ids = np.array([key[0] for key in keys])
+        change = np.abs(normalized - stored)
+        print('{:<8} {:>12} {:>14} {:>12} {:>10}'.format('sensor', 'measures', 'mean change', 'max change', 'changed'))
+        for sensor_id in np.unique(sensor_ids):
+            c = change[sensor_ids == sensor_id]
+            c = c[~np.isnan(c)]
+            if len(c) == 0:
+                continue
+            print('{:<8} {:>12} {:>14.3f} {:>12.1f} {:>10}'.format(sensor_names.get(int(sensor_id), sensor_id), len(c), c.mean(), c.max(), int((c > 0).sum())))
+
+    if args.apply and len(keys) > 0:
+        apply(cur, keys, normalized)
+        db.commit()
+        print('Stored values updated')
+
+    db.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,184 @@
+import sys
+import time
+import argparse
+import threading
+from datetime import datetime, timedelta
+
+import storage
+import rollup
+import metrics
+import sync_agent
+
+# Retention: raw measures (and their samples) are kept raw_days, hourly rollups hourly_days and daily rollups
+# forever, so the database stops growing once the raw window is full. The irrigation log is kept: it's a few
+# rows a day and the irrigation cycles are rebuilt from it.
+# Rows are deleted in small batches, each in its own short transaction with a pause in between, and the freed
+# pages are returned with PRAGMA incremental_vacuum, so the web routes and measurements are never locked out.
+# Cutoffs are at the start of a (local) day, so the oldest raw day is always complete and rollup.rebuild_rollups()
+# can rebuild from the raw measures without touching older buckets.
+# Entries of the fleet sync outbox (sync_agent.py) for rows that are gone or older than the raw cutoff are removed
+# as well, so the outbox doesn't grow forever while the collector can't be reached.
+#
+#   python3 retention.py --raw-days 90 [--hourly-days 365] [path to database]
+
+# (table, time column, policy): what is deleted by which setting
+TABLES = [
+    ('measure', 'ts', 'raw_days'),
+    ('measure_raw', 'ts', 'raw_days'),
+    ('measure_hourly', 'bucket', 'hourly_days'),
+]
+
+def cutoff(days, now=None):
+    # start of the day `days` ago, None when kept forever (0)
+    if days is None or days <= 0:
+        return None
+    return rollup.bucket_start((now or datetime.now()) - timedelta(days=days), 'day')
+
+def available_resolution(start_dt, resolution, raw_days, hourly_days):
+
+    # coarser resolution when the start of the range is beyond what is kept of the requested one
+    start_ts = int(start_dt.timestamp())
+    raw_cutoff = cutoff(raw_days)
+    hourly_cutoff = cutoff(hourly_days)
+    if resolution == 'raw' and raw_cutoff is not None and start_ts < raw_cutoff:
+        resolution = 'hour'
+    if resolution == 'hour' and hourly_cutoff is not None and start_ts < hourly_cutoff:
+        resolution = 'day'
+    return resolution
+
+def delete_batch(cur, table, column, sensor_id, before, batch_size):
+
+    # oldest batch_size rows of one sensor, along the (sensor_id, time) primary key
+    res = cur.execute('SELECT ' + column + ' FROM ' + table + ' WHERE sensor_id = ? AND ' + column + ' < ? ORDER BY ' + column + ' LIMIT 1 OFFSET ?',
+        (sensor_id, before, batch_size)).fetchone()
+    upto = res[0] if res is not None else before
+    cur.execute('DELETE FROM ' + table + ' WHERE sensor_id = ? AND ' + column + ' < ?', (sensor_id, upto))
+    return cur.rowcount
+
+def enable_incremental_vacuum(path=None):
+
+    # switches the database to incremental auto vacuum the first time retention is used on it: one full VACUUM
+    # that rewrites the file, so it's only done when retention is enabled; returns True when it was switched
+    db = storage.connect(path)
+    try:
+        if db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            return False
+        print('Switching', path or storage.DATABASE, 'to incremental auto vacuum, this rewrites the database once')
+        db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        db.execute('VACUUM')
+        return True
+    finally:
+        db.close()
+
+def incremental_vacuum(db, pages):
+    # returns the pages left on the freelist
+    db.execute('PRAGMA incremental_vacuum(' + str(int(pages)) + ')').fetchall()
+    return db.execute('PRAGMA freelist_count').fetchone()[0]
+
+def run(raw_days, hourly_days, batch_size=2000, pause=0.05, vacuum_pages=200, stop=None):
+
+    # one retention pass on this thread's connection, returns {table: deleted rows}
+    start = time.perf_counter()
+    policy = {'raw_days': cutoff(raw_days), 'hourly_days': cutoff(hourly_days)}
+    db = storage.get_connection()
+    sensor_ids = [res[0] for res in db.execute('SELECT id FROM sensor')]
+    # without incremental auto vacuum (see enable_incremental_vacuum) freed pages are only reused, not given back
+    if db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        vacuum_pages = 0
+    deleted = {}
+
+    for table, column, setting in TABLES:
+        before = policy[setting]
+        if before is None:
+            continue
+        deleted[table] = 0
+        for sensor_id in sensor_ids:
+            while stop is None or not stop.is_set():
+                with storage.transaction() as cur:
+                    count = delete_batch(cur, table, column, sensor_id, before, batch_size)
+                deleted[table] = deleted[table] + count
+                metrics.inc('irrigation_retention_deleted_rows_total', count, table=table)
+                if count == 0:
+                    break
+                if vacuum_pages > 0:
+                    incremental_vacuum(db, vacuum_pages)
+                # give other threads (web routes, measurements) the database between batches
+                time.sleep(pause)
+
+    # sync outbox: entries of the removed rows would never be sent
+    if policy['raw_days'] is not None:
+        deleted['sync_outbox'] = 0
+        while stop is None or not stop.is_set():
+            with storage.transaction() as cur:
+                count = sync_agent.prune(cur, policy['raw_days'], batch_size)
+            deleted['sync_outbox'] = deleted['sync_outbox'] + count
+            metrics.inc('irrigation_retention_deleted_rows_total', count, table='sync_outbox')
+            if count == 0:
+                break
+            if vacuum_pages > 0:
+                incremental_vacuum(db, vacuum_pages)
+            time.sleep(pause)
+
+    # whatever is left on the freelist, still in small steps
+    while vacuum_pages > 0 and (stop is None or not stop.is_set()) and incremental_vacuum(db, vacuum_pages) > 0:
+        time.sleep(pause)
+
+    metrics.observe('irrigation_retention_run_seconds', time.perf_counter() - start)
+    return deleted
+
+class RetentionWorker:
+
+    # runs a retention pass every interval_hours on a background thread
+    def __init__(self, raw_days, hourly_days, interval_hours=24):
+        self.raw_days = raw_days
+        self.hourly_days = hourly_days
+        self.interval_hours = interval_hours
+        self.stopped = threading.Event()
+        self.worker = None
+
+    def start(self):
+        if self.worker is not None:
+            return
+        self.worker = threading.Thread(target=self.work, name='retention', daemon=True)
+        self.worker.start()
+
+    def work(self):
+        # first pass shortly after startup, not during it
+        self.stopped.wait(60)
+        while not self.stopped.is_set():
+            try:
+                deleted = run(self.raw_days, self.hourly_days, stop=self.stopped)
+                if sum(deleted.values()) > 0:
+                    print('Retention removed', deleted)
+            except Exception as error:
+                print('Retention failed', error)
+            self.stopped.wait(self.interval_hours * 3600)
+
+    def stop(self):
+        self.stopped.set()
+
+def main(args):
+
+    parser = argparse.ArgumentParser(description='Remove raw measures and hourly rollups beyond the retention period')
+    parser.add_argument('database', nargs='?', default=storage.DATABASE)
+    parser.add_argument('--raw-days', type=int, required=True, help='keep raw measures and samples this many days (0 keeps them forever)')
+    parser.add_argument('--hourly-days', type=int, default=365, help='keep hourly rollups this many days (0 keeps them forever), daily rollups are always kept')
+    args = parser.parse_args(args)
+
+    storage.DATABASE = args.database
+    storage.init_schema(args.database)
+    enable_incremental_vacuum(args.database)
+    db = storage.get_connection()
+    pages = db.execute('PRAGMA page_count').fetchone()[0]
+    page_size = db.execute('PRAGMA page_size').fetchone()[0]
+
+    start = time.perf_counter()
+    deleted = run(args.raw_days, args.hourly_days, pause=0)
+    db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    print('Removed', deleted, 'in {:.1f} s'.format(time.perf_counter() - start))
+    print('Database {:.1f} MB > {:.1f} MB'.format(pages * page_size / 1024 / 1024, db.execute('PRAGMA page_count').fetchone()[0] * page_size / 1024 / 1024))
+    storage.close_connection()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,149 @@
+from datetime import datetime, timedelta
+
+# Pre-aggregated rollups of the measures: min/max/sum/count per sensor per hour and per day
+# Updated incrementally on every insert so charts over weeks/months/seasons don't have to scan all raw rows
+# Buckets are epoch seconds of the start of the (local time) hour or day, like measure.ts
+
+ROLLUP_TABLES = {
+    'hour': 'measure_hourly',
+    'day': 'measure_daily',
+}
+
+# bucket of measure.ts in SQL, same as bucket_start()
+BUCKET_SQL = {
+    'hour': 'CAST(strftime(\'%s\', strftime(\'%Y-%m-%d %H:00:00\', m.ts, \'unixepoch\', \'localtime\'), \'utc\') AS INTEGER)',
+    'day': 'CAST(strftime(\'%s\', date(m.ts, \'unixepoch\', \'localtime\'), \'utc\') AS INTEGER)',
+}
+
+def init_measure_tables(cur):
+
+    # layout of schema version 1 (storage.migrate_1): measure_val with iso dt strings and rollups keyed on the
+    # sensor name, kept as it was so older databases migrate the same way; migrate_3 converts it to the current one
+    cur.execute('CREATE TABLE IF NOT EXISTS measure_val (sensor TEXT, dt TEXT, val REAL)')
+    cur.execute('CREATE INDEX IF NOT EXISTS measure_val_sensor_dt ON measure_val (sensor, dt)')
+
+    is_new = False
+    for table in ROLLUP_TABLES.values():
+        if cur.execute('SELECT name FROM sqlite_master WHERE type = \'table\' AND name = ?', (table, )).fetchone() is None:
+            is_new = True
+        cur.execute('CREATE TABLE IF NOT EXISTS ' + table + ' (sensor TEXT, bucket TEXT, val_min REAL, val_max REAL, val_sum REAL, val_count INTEGER, PRIMARY KEY (sensor, bucket))')
+
+    if is_new:
+        # first run on an existing database: build rollups from all history collected so far
+        # dt is stored as 'YYYY-MM-DD HH:MM:SS.ffffff' so the buckets are plain prefixes
+        buckets = {
+            'hour': 'substr(dt, 1, 13) || \':00:00\'',
+            'day': 'substr(dt, 1, 10) || \' 00:00:00\'',
+        }
+        cur.connection.create_function('measure_valid', 2, is_valid, deterministic=True)
+        for resolution, table in ROLLUP_TABLES.items():
+            cur.execute('DELETE FROM ' + table)
+            cur.execute('INSERT INTO ' + table + ' (sensor, bucket, val_min, val_max, val_sum, val_count) '
+                'SELECT sensor, ' + buckets[resolution] + ', min(val), max(val), sum(val), count(*) FROM measure_val WHERE measure_valid(sensor, val) GROUP BY 1, 2')
+
+def init_rollup_tables(cur):
+
+    for table in ROLLUP_TABLES.values():
+        cur.execute('CREATE TABLE IF NOT EXISTS ' + table + ' (sensor_id INTEGER NOT NULL, bucket INTEGER NOT NULL, val_min REAL, val_max REAL, val_sum REAL, val_count INTEGER, '
+            'PRIMARY KEY (sensor_id, bucket)) WITHOUT ROWID')
+
+def is_valid(sensor, val):
+
+    # same rules the charts have always used to ignore bad readings
+    # sensors of other nodes on the collector are named 'node/sensor'
+    sensor = sensor.rsplit('/', 1)[-1]
+    if sensor == 'moist':
+        return val >= 380 and val <= 540
+    if sensor == 'temp':
+        return val > 0 # won't expect temps below zero in Sydney, hopefully ;)
+    if sensor == 'humid':
+        return val > 0 and val <= 100
+    return True
+
+def bucket_start(dt, resolution):
+
+    if resolution == 'hour':
+        dt = dt.replace(minute=0, second=0, microsecond=0)
+    else:
+        dt = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    return int(dt.timestamp())
+
+def update_rollups(cur, sensor_id, sensor, dt, val):
+
+    if not is_valid(sensor, val):
+        # keep invalid readings in the raw measures for diagnostics but out of the aggregates
+        return
+
+    for resolution, table in ROLLUP_TABLES.items():
+        cur.execute('INSERT INTO ' + table + ' (sensor_id, bucket, val_min, val_max, val_sum, val_count) VALUES (?, ?, ?, ?, ?, 1) '
+            'ON CONFLICT (sensor_id, bucket) DO UPDATE SET val_min = min(val_min, excluded.val_min), val_max = max(val_max, excluded.val_max), '
+            'val_sum = val_sum + excluded.val_sum, val_count = val_count + 1',
+            (sensor_id, bucket_start(dt, resolution), val, val, val))
+
+def rebuild_rollups(cur):
+
+    # rebuilds every bucket from the oldest raw measure of each sensor on; older buckets whose raw measures were
+    # removed by retention.py are kept as they are
+    cur.connection.create_function('measure_valid', 2, is_valid, deterministic=True)
+    for resolution, table in ROLLUP_TABLES.items():
+        cur.execute('DELETE FROM ' + table + ' WHERE bucket >= (SELECT ' + BUCKET_SQL[resolution] + ' FROM measure m WHERE m.sensor_id = ' + table + '.sensor_id ORDER BY m.ts LIMIT 1)')
+        cur.execute('INSERT INTO ' + table + ' (sensor_id, bucket, val_min, val_max, val_sum, val_count) '
+            'SELECT m.sensor_id, ' + BUCKET_SQL[resolution] + ', min(m.val), max(m.val), sum(m.val), count(*) '
+            'FROM measure m JOIN sensor s ON s.id = m.sensor_id WHERE measure_valid(s.name, m.val) GROUP BY 1, 2')
+
+def rebuild_rollups_range(cur, sensor_id, start_ts, end_ts):
+
+    # rebuild the buckets of one sensor that hold start_ts..end_ts from the measures, e.g. after a bulk insert
+    # (unlike update_rollups() this can be repeated for the same rows without counting them twice)
+    cur.connection.create_function('measure_valid', 2, is_valid, deterministic=True)
+    for resolution, table in ROLLUP_TABLES.items():
+        first = bucket_start(datetime.fromtimestamp(start_ts), resolution)
+        step = timedelta(hours=1) if resolution == 'hour' else timedelta(days=1)
+        after_last = bucket_start(datetime.fromtimestamp(end_ts) + step, resolution)
+        cur.execute('DELETE FROM ' + table + ' WHERE sensor_id = ? AND bucket >= ? AND bucket < ?', (sensor_id, first, after_last))
+        cur.execute('INSERT INTO ' + table + ' (sensor_id, bucket, val_min, val_max, val_sum, val_count) '
+            'SELECT m.sensor_id, ' + BUCKET_SQL[resolution] + ', min(m.val), max(m.val), sum(m.val), count(*) '
+            'FROM measure m JOIN sensor s ON s.id = m.sensor_id WHERE m.sensor_id = ? AND m.ts >= ? AND m.ts < ? AND measure_valid(s.name, m.val) GROUP BY 1, 2',
+            (sensor_id, first, after_last))
+
+def pick_resolution(start_dt, end_dt):
+
+    # keep number of points per series roughly constant: raw for a week or two, hourly up to a quarter, daily beyond that
+    span = end_dt - start_dt
+    if span <= timedelta(days=14):
+        return 'raw'
+    if span <= timedelta(days=120):
+        return 'hour'
+    return 'day'
+
+def query_multi_series(cur, sensors, start_dt, end_dt, resolution):
+
+    # all requested sensors in one query, yields (sensor, ts, mean) ordered by sensor and ts asc
+    # end_dt None means no upper bound
+    marks = ','.join(['?'] * len(sensors))
+    end_ts = int(end_dt.timestamp()) if end_dt is not None else 2 ** 62
+    if resolution == 'raw':
+        for res in cur.execute('SELECT s.name, m.ts, m.val FROM sensor s JOIN measure m ON m.sensor_id = s.id WHERE s.name IN (' + marks + ') AND m.ts >= ? AND m.ts <= ? ORDER BY s.name, m.ts',
+                list(sensors) + [int(start_dt.timestamp()), end_ts]):
+            if is_valid(res[0], res[2]):
+                yield res
+        return
+
+    table = ROLLUP_TABLES[resolution]
+    for res in cur.execute('SELECT s.name, r.bucket, round(r.val_sum / r.val_count, 1) FROM sensor s JOIN ' + table + ' r ON r.sensor_id = s.id WHERE s.name IN (' + marks + ') AND r.bucket >= ? AND r.bucket <= ? ORDER BY s.name, r.bucket',
+            list(sensors) + [bucket_start(start_dt, resolution), end_ts]):
+        yield res
+
+if __name__ == '__main__':
+
+    # rebuild all rollups by hand: python3 rollup.py [path to database]
+    import sys
+    import storage
+
+    path = sys.argv[1] if len(sys.argv) > 1 else storage.DATABASE
+    storage.init_schema(path)
+    db = storage.connect(path)
+    rebuild_rollups(db.cursor())
+    db.commit()
+    db.close()
+    print('Rollups rebuilt')
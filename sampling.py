@@ -0,0 +1,70 @@
+import time
+import threading
+
+import metrics
+
+# Sampling engine: every sensor is read on its own thread with its own number of samples and interval,
+# so all sensors are sampled in parallel while the sensor power is on instead of one after another.
+# A read function returns a dict of {sensor: value} (one reading can hold several values, e.g. DHT22
+# temp + humid) or None when the reading is invalid and should be skipped.
+
+class Sampler:
+
+    def __init__(self, name, read, samples, interval):
+        self.name = name
+        self.read = read
+        self.samples = samples
+        self.interval = interval
+
+    def duration(self):
+        return self.samples * self.interval
+
+def run_sampler(sampler, results, lock):
+
+    next_read = time.monotonic()
+    for i in range(sampler.samples):
+        try:
+            with metrics.timer('irrigation_sensor_read_seconds', sensor=sampler.name):
+                values = sampler.read()
+        except Exception as error:
+            # keep sampling, one failed read shouldn't lose the other samples
+            print('Failed to read', sampler.name, error)
+            values = None
+
+        if values is None:
+            metrics.inc('irrigation_sensor_read_failures_total', sensor=sampler.name)
+        else:
+            with lock:
+                for sensor, value in values.items():
+                    results.setdefault(sensor, []).append(value)
+
+        # keep a fixed rate: a slow read eats into the pause instead of adding to it
+        next_read = next_read + sampler.interval
+        if i < sampler.samples - 1:
+            time.sleep(max(0, next_read - time.monotonic()))
+
+def sample_all(samplers):
+
+    # returns {sensor: [values]} once all samplers are done
+    results = {}
+    lock = threading.Lock()
+    threads = []
+    for sampler in samplers:
+        t = threading.Thread(target=run_sampler, args=(sampler, results, lock), name='sampler-' + sampler.name, daemon=True)
+        t.start()
+        threads.append(t)
+
+    for t in threads:
+        t.join()
+
+    return results
+
+def trimmed_mean(values, trim=0.1):
+
+    # filtered value of an oversampled burst: mean without the lowest and highest trim (proportion) of the readings,
+    # spikes are dropped and averaging the rest gives a finer and less noisy value than a single reading
+    values = sorted(values)
+    cut = int(len(values) * trim)
+    if len(values) - 2 * cut > 0:
+        values = values[cut:len(values) - cut]
+    return sum(values) / len(values)
@@ -0,0 +1,89 @@
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+# Runs measurement jobs on a background thread so web requests return straight away
+# There is only one worker thread so there's never more than one sensor power cycle at a time;
+# triggers while a job is waiting or running are merged into that job instead of queueing another one
+
+class SamplingScheduler:
+
+    def __init__(self, run_job, interval_minutes=0, keep_jobs=50):
+        self.run_job = run_job
+        self.interval_minutes = interval_minutes
+        self.keep_jobs = keep_jobs
+        self.jobs = OrderedDict()
+        self.pending = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.worker = None
+        self.timer = None
+
+    def start(self):
+        if self.worker is not None:
+            return
+        self.worker = threading.Thread(target=self.work, name='sampling-worker', daemon=True)
+        self.worker.start()
+        if self.interval_minutes > 0:
+            self.timer = threading.Thread(target=self.schedule, name='sampling-schedule', daemon=True)
+            self.timer.start()
+
+    def trigger(self, source='manual'):
+        # returns the job that will take (or is taking) the measurement
+        with self.lock:
+            for job in self.jobs.values():
+                if job['status'] in ('queued', 'running'):
+                    return dict(job)
+
+            job = {
+                'id': uuid.uuid4().hex[:12],
+                'source': source,
+                'status': 'queued',
+                'created': datetime.now().isoformat(),
+                'started': None,
+                'finished': None,
+                'error': None,
+            }
+            self.jobs[job['id']] = job
+            while len(self.jobs) > self.keep_jobs:
+                self.jobs.popitem(last=False)
+            self.pending = job['id']
+            self.wakeup.notify()
+            return dict(job)
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def work(self):
+        while True:
+            with self.lock:
+                while self.pending is None:
+                    self.wakeup.wait()
+                job = self.jobs.get(self.pending)
+                self.pending = None
+                if job is None:
+                    continue
+                job['status'] = 'running'
+                job['started'] = datetime.now().isoformat()
+
+            error = None
+            try:
+                self.run_job()
+            except Exception as e:
+                # keep the worker alive, the job shows what went wrong
+                print('Measurement job failed:', e)
+                error = str(e)
+
+            with self.lock:
+                job['status'] = 'failed' if error else 'done'
+                job['error'] = error
+                job['finished'] = datetime.now().isoformat()
+
+    def schedule(self):
+        while True:
+            time.sleep(self.interval_minutes * 60)
+            self.trigger('schedule')
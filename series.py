@@ -0,0 +1,79 @@
+import json
+from datetime import datetime
+
+import rollup
+import metrics
+import downsample
+
+# Columnar chart series as served by /api/series, shared by the app and the fleet collector (collector.py)
+# {"resolution": .., "series": {"moist": {"t": [epoch ms, ..], "v": [..]}, ..}}
+# Pseudo sensor 'irrigation' holds the valve ON/OFF events from irrigation_log (v: 1 is ON, 0 is OFF).
+# prefix selects the sensors and valves of one node on the collector ('zone1/'), names are sent without it.
+
+def irrigation_events(cur, start_dt, end_dt, prefix=''):
+
+    # dt is stored as text; no timezone conversion needed, Javascript takes care of that
+    t = []
+    v = []
+    for res in cur.execute('SELECT dt, status FROM irrigation_log WHERE dt >= ? AND dt <= ? AND substr(valve, 1, ?) = ? ORDER BY dt ASC',
+            (str(start_dt), str(end_dt or datetime.max), len(prefix), prefix)):
+        t.append(int(datetime.fromisoformat(res[0]).timestamp()) * 1000)
+        v.append(1 if res[1] == 'status_on' else 0)
+    return t, v
+
+def stream(cur, sensors, start_dt, end_dt, resolution, points=0, prefix=''):
+
+    # yields the json in parts, only one series is buffered at any time
+    # points > 0 downsamples every sensor series (LTTB), irrigation events are never dropped
+    yield '{"resolution":' + json.dumps(resolution) + ',"series":{'
+
+    is_first = True
+    sent = []
+    measure_sensors = [prefix + x for x in sensors if x != 'irrigation']
+
+    # valve events first: they are pinned when downsampling so the moisture drop after watering stays visible
+    irrigation_t = []
+    irrigation_v = []
+    if 'irrigation' in sensors or points > 0:
+        irrigation_t, irrigation_v = irrigation_events(cur, start_dt, end_dt, prefix)
+
+    def series_json(name, t, v):
+        if points > 0 and name != 'irrigation':
+            with metrics.timer('irrigation_downsample_seconds'):
+                t, v = downsample.downsample(t, v, points, irrigation_t)
+        return ('' if is_first else ',') + json.dumps(name) + ':{"t":' + json.dumps(t, separators=(',', ':')) + ',"v":' + json.dumps(v, separators=(',', ':')) + '}'
+
+    if len(measure_sensors) > 0:
+        name = None
+        t = []
+        v = []
+        # ts is epoch seconds already, no conversion needed for Javascript
+        for res in rollup.query_multi_series(cur, measure_sensors, start_dt, end_dt, resolution):
+            if res[0] != name:
+                if name is not None:
+                    yield series_json(name[len(prefix):], t, v)
+                    is_first = False
+                    sent.append(name[len(prefix):])
+                name = res[0]
+                t = []
+                v = []
+            t.append(res[1] * 1000)
+            v.append(res[2])
+        if name is not None:
+            yield series_json(name[len(prefix):], t, v)
+            is_first = False
+            sent.append(name[len(prefix):])
+
+    if 'irrigation' in sensors:
+        yield series_json('irrigation', irrigation_t, irrigation_v)
+        is_first = False
+        sent.append('irrigation')
+
+    # sensors without any data in range still get (empty) arrays
+    for name in sensors:
+        if name not in sent:
+            yield series_json(name, [], [])
+            is_first = False
+            sent.append(name)
+
+    yield '}}'
@@ -0,0 +1,186 @@
+import os
+import sqlite3
+import threading
+from array import array
+from contextlib import contextmanager
+
+import rollup
+import irrigation_cycle
+
+# SQLite storage layer
+# - WAL journal so readers (web pages) are never blocked by a write in progress, synchronous=NORMAL
+#   so a commit doesn't fsync on every transaction (SD card wear), only at checkpoints
+# - schema is created/migrated once at startup (PRAGMA user_version holds the schema version)
+# - one connection per thread which is reused for all requests/jobs running on that thread
+
+DATABASE = 'db/database.db'
+
+local = threading.local()
+
+def connect(path=None):
+
+    db = sqlite3.connect(path or DATABASE, timeout=10)
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')
+    db.execute('PRAGMA temp_store = MEMORY')
+    db.execute('PRAGMA busy_timeout = 10000')
+    return db
+
+def get_connection():
+
+    db = getattr(local, 'db', None)
+    if db is not None and local.path != DATABASE:
+        # database was switched (benchmarks, tools)
+        db.close()
+        db = None
+    if db is None:
+        db = local.db = connect()
+        local.path = DATABASE
+    return db
+
+def close_connection():
+
+    db = getattr(local, 'db', None)
+    if db is not None:
+        db.close()
+        local.db = None
+
+@contextmanager
+def transaction():
+
+    # all statements in the block are committed together (or rolled back on error)
+    db = get_connection()
+    cur = db.cursor()
+    try:
+        yield cur
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
+
+# sensors get fixed ids so they are the same in every database
+SENSORS = ['temp', 'humid', 'moist', 'cpu']
+
+sensor_ids = {}
+
+def migrate_1(cur):
+    cur.execute('CREATE TABLE IF NOT EXISTS irrigation_log (valve TEXT, dt TEXT, status TEXT, source TEXT, control_type TEXT)')
+    cur.execute('CREATE INDEX IF NOT EXISTS irrigation_log_dt ON irrigation_log (dt)')
+    # measure_val, (sensor, dt) index and rollups (built from existing history when new)
+    rollup.init_measure_tables(cur)
+
+def migrate_2(cur):
+    is_new = cur.execute('SELECT name FROM sqlite_master WHERE type = \'table\' AND name = \'irrigation_cycle\'').fetchone() is None
+    irrigation_cycle.init_cycle_table(cur)
+    if is_new:
+        irrigation_cycle.rebuild_cycles(cur)
+
+def migrate_3(cur):
+    # compact measures: epoch seconds instead of 26 character iso strings, sensor id instead of name,
+    # clustered on (sensor_id, ts) so a sensor's range is one contiguous read (see compact_schema.py)
+    cur.execute('CREATE TABLE IF NOT EXISTS sensor (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
+    cur.executemany('INSERT OR IGNORE INTO sensor (id, name) VALUES (?, ?)', [(i + 1, name) for i, name in enumerate(SENSORS)])
+    cur.execute('CREATE TABLE IF NOT EXISTS measure (sensor_id INTEGER NOT NULL, ts INTEGER NOT NULL, val REAL, PRIMARY KEY (sensor_id, ts)) WITHOUT ROWID')
+    cur.execute('CREATE INDEX IF NOT EXISTS measure_ts ON measure (ts)')
+
+    if cur.execute('SELECT name FROM sqlite_master WHERE type = \'table\' AND name = \'measure_val\'').fetchone() is not None:
+        # dt was stored as local time, strftime(.., 'utc') converts it to epoch like datetime.timestamp() does
+        cur.execute('INSERT OR IGNORE INTO sensor (name) SELECT DISTINCT sensor FROM measure_val')
+        cur.execute('INSERT OR REPLACE INTO measure (sensor_id, ts, val) '
+            'SELECT s.id, CAST(strftime(\'%s\', m.dt, \'utc\') AS INTEGER), m.val FROM measure_val m JOIN sensor s ON s.name = m.sensor')
+        cur.execute('DROP TABLE measure_val')
+
+    cur.execute('DROP TABLE IF EXISTS measure_hourly')
+    cur.execute('DROP TABLE IF EXISTS measure_daily')
+    rollup.init_rollup_tables(cur)
+    rollup.rebuild_rollups(cur)
+
+    # old layout as a view for ad-hoc queries in the sqlite3 shell
+    cur.execute('CREATE VIEW IF NOT EXISTS measure_val AS SELECT s.name AS sensor, datetime(m.ts, \'unixepoch\', \'localtime\') AS dt, m.val AS val '
+        'FROM measure m JOIN sensor s ON s.id = m.sensor_id')
+
+def migrate_4(cur):
+    # raw samples of every measurement, packed as float32 (see pack_samples), so the normalisation can be redone later
+    cur.execute('CREATE TABLE IF NOT EXISTS measure_raw (sensor_id INTEGER NOT NULL, ts INTEGER NOT NULL, samples BLOB NOT NULL, PRIMARY KEY (sensor_id, ts)) WITHOUT ROWID')
+
+def migrate_5(cur):
+    # incremental auto vacuum so retention.py can give the pages of deleted rows back in small steps;
+    # changing it needs one full VACUUM (outside a transaction), so only a new database is switched here and
+    # existing ones when retention is enabled (retention.enable_incremental_vacuum())
+    is_new = cur.execute('SELECT 1 FROM measure LIMIT 1').fetchone() is None
+    if is_new and cur.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        cur.connection.commit()
+        cur.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cur.execute('VACUUM')
+
+# append new migrations at the end, never change existing ones (version = position in list)
+MIGRATIONS = [
+    migrate_1,
+    migrate_2,
+    migrate_3,
+    migrate_4,
+    migrate_5,
+]
+
+def init_schema(path=None):
+
+    path = path or DATABASE
+    if os.path.dirname(path) != '':
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    db = connect(path)
+    try:
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        for i in range(version, len(MIGRATIONS)):
+            print('Migrating database schema to version', i + 1)
+            cur = db.cursor()
+            MIGRATIONS[i](cur)
+            cur.execute('PRAGMA user_version = ' + str(i + 1))
+            db.commit()
+    finally:
+        db.close()
+
+def get_sensor_id(cur, name):
+
+    sensor_id = sensor_ids.get(name)
+    if sensor_id is None:
+        cur.execute('INSERT OR IGNORE INTO sensor (name) VALUES (?)', (name, ))
+        sensor_id = sensor_ids[name] = cur.execute('SELECT id FROM sensor WHERE name = ?', (name, )).fetchone()[0]
+    return sensor_id
+
+def pack_samples(samples):
+    return array('f', samples).tobytes()
+
+def unpack_samples(blob):
+    samples = array('f')
+    samples.frombytes(blob)
+    return samples.tolist()
+
+def insert_measures(cur, timestamp, values, samples=None):
+
+    # values: {sensor: value}, all rows of one measurement in a single executemany
+    # samples: {sensor: [raw samples]} the values were normalised from
+    ts = int(timestamp.timestamp())
+    rows = [(get_sensor_id(cur, sensor), ts, value) for sensor, value in values.items()]
+    # a measurement in the same second as the one before replaces its rows: their buckets are rebuilt instead
+    # of adding the value to the rollups a second time
+    replaced = set(res[0] for res in cur.execute('SELECT sensor_id FROM measure WHERE ts = ?', (ts, )))
+    cur.executemany('INSERT OR REPLACE INTO measure (sensor_id, ts, val) VALUES (?, ?, ?)', rows)
+    for sensor, value in values.items():
+        sensor_id = get_sensor_id(cur, sensor)
+        if sensor_id in replaced:
+            rollup.rebuild_rollups_range(cur, sensor_id, ts, ts)
+        else:
+            rollup.update_rollups(cur, sensor_id, sensor, timestamp, value)
+
+    if samples:
+        cur.executemany('INSERT OR REPLACE INTO measure_raw (sensor_id, ts, samples) VALUES (?, ?, ?)',
+            [(get_sensor_id(cur, sensor), ts, pack_samples(lst)) for sensor, lst in samples.items() if len(lst) > 0])
+
+def insert_irrigation_log(cur, valve, timestamp, status, source, control_type, is_test=False):
+
+    cur.execute('INSERT INTO irrigation_log (valve, dt, status, source, control_type) VALUES (?, ?, ?, ?, ?)',
+        (valve, timestamp, status, source, control_type))
+    irrigation_cycle.record_event(cur, valve, timestamp, status, is_test)
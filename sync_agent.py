@@ -0,0 +1,249 @@
+import os
+import sys
+import gzip
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import urllib.request
+import urllib.error
+
+import storage
+import metrics
+
+# Fleet sync agent: ships the measures and irrigation log of this Pi to a collector (collector.py)
+# New and updated rows are spooled in the sync_outbox table by triggers, so nothing is missed whoever writes
+# them (measurements, write buffer, tools). Rows are sent in gzipped json batches, each carrying the outbox
+# sequence numbers it covers and the epoch of the outbox; the collector remembers the sequence numbers and a digest
+# of the last batch per node and epoch and acknowledges that batch again without storing it, so a batch can be
+# resent safely after a timeout. Acknowledged rows are removed from the outbox.
+# The epoch is a random id created with the outbox: a recreated database (new SD card) numbers its outbox from 1
+# again under a new epoch. A database restored from a backup keeps its epoch but reuses sequence numbers the
+# collector already has for other rows; the collector refuses those batches (409) and the agent starts a new epoch.
+# While the collector can't be reached the outbox keeps growing and is sent batch by batch when it's back.
+#
+#   python3 sync_agent.py --collector http://collector:5001 [--node zone1] [--once] [path to database]
+#   python3 sync_agent.py --uninstall [path to database]    (stop queueing rows when syncing isn't used anymore)
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS sync_outbox (seq INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, key1 INTEGER NOT NULL, key2 INTEGER)',
+    # measure: key1 sensor_id, key2 ts; irrigation: key1 rowid of irrigation_log
+    'CREATE TRIGGER IF NOT EXISTS sync_measure_insert AFTER INSERT ON measure BEGIN '
+        'INSERT INTO sync_outbox (kind, key1, key2) VALUES (\'measure\', NEW.sensor_id, NEW.ts); END',
+    'CREATE TRIGGER IF NOT EXISTS sync_measure_update AFTER UPDATE OF val ON measure BEGIN '
+        'INSERT INTO sync_outbox (kind, key1, key2) VALUES (\'measure\', NEW.sensor_id, NEW.ts); END',
+    'CREATE TRIGGER IF NOT EXISTS sync_irrigation_insert AFTER INSERT ON irrigation_log BEGIN '
+        'INSERT INTO sync_outbox (kind, key1) VALUES (\'irrigation\', NEW.rowid); END',
+    'CREATE TABLE IF NOT EXISTS sync_epoch (epoch TEXT NOT NULL)',
+]
+
+def install(cur):
+
+    # outbox and triggers are only created once syncing is used; the history so far is queued as backlog
+    is_new = cur.execute('SELECT name FROM sqlite_master WHERE type = \'table\' AND name = \'sync_outbox\'').fetchone() is None
+    for statement in SCHEMA:
+        cur.execute(statement)
+    if is_new:
+        cur.execute('INSERT INTO sync_outbox (kind, key1, key2) SELECT \'measure\', sensor_id, ts FROM measure ORDER BY ts')
+        cur.execute('INSERT INTO sync_outbox (kind, key1) SELECT \'irrigation\', rowid FROM irrigation_log ORDER BY rowid')
+    get_epoch(cur)
+    return is_new
+
+def get_epoch(cur):
+    res = cur.execute('SELECT epoch FROM sync_epoch').fetchone()
+    if res is None:
+        return new_epoch(cur)
+    return res[0]
+
+def new_epoch(cur):
+    epoch = os.urandom(8).hex()
+    cur.execute('DELETE FROM sync_epoch')
+    cur.execute('INSERT INTO sync_epoch (epoch) VALUES (?)', (epoch, ))
+    return epoch
+
+def uninstall(cur):
+
+    # removes triggers, outbox and epoch, returns the number of rows that were still queued
+    if cur.execute('SELECT name FROM sqlite_master WHERE type = \'table\' AND name = \'sync_outbox\'').fetchone() is None:
+        return 0
+    count = cur.execute('SELECT count(*) FROM sync_outbox').fetchone()[0]
+    for trigger in ('sync_measure_insert', 'sync_measure_update', 'sync_irrigation_insert'):
+        cur.execute('DROP TRIGGER IF EXISTS ' + trigger)
+    cur.execute('DROP TABLE IF EXISTS sync_outbox')
+    cur.execute('DROP TABLE IF EXISTS sync_epoch')
+    return count
+
+def prune(cur, before, batch_size):
+
+    # removes up to batch_size outbox entries whose row is gone, or measures older than before (epoch seconds,
+    # removed by retention soon anyway); returns the number removed
+    if cur.execute('SELECT name FROM sqlite_master WHERE type = \'table\' AND name = \'sync_outbox\'').fetchone() is None:
+        return 0
+    cur.execute('DELETE FROM sync_outbox WHERE seq IN (SELECT o.seq FROM sync_outbox o WHERE '
+        '(o.kind = \'measure\' AND (o.key2 < ? OR NOT EXISTS (SELECT 1 FROM measure m WHERE m.sensor_id = o.key1 AND m.ts = o.key2))) OR '
+        '(o.kind = \'irrigation\' AND NOT EXISTS (SELECT 1 FROM irrigation_log l WHERE l.rowid = o.key1)) LIMIT ?)', (before, batch_size))
+    return cur.rowcount
+
+def next_batch(cur, batch_size):
+
+    # (first seq, last seq, payload) of the oldest batch_size outbox entries, None when empty
+    # rows removed since they were queued (retention) are skipped, updated ones are sent as they are now
+    rows = cur.execute('SELECT o.seq, o.kind, s.name, m.ts, m.val, l.valve, l.dt, l.status, l.source, l.control_type FROM sync_outbox o '
+        'LEFT JOIN measure m ON o.kind = \'measure\' AND m.sensor_id = o.key1 AND m.ts = o.key2 '
+        'LEFT JOIN sensor s ON s.id = m.sensor_id '
+        'LEFT JOIN irrigation_log l ON o.kind = \'irrigation\' AND l.rowid = o.key1 '
+        'ORDER BY o.seq LIMIT ?', (batch_size, )).fetchall()
+    if len(rows) == 0:
+        return None
+
+    # measures columnar like /api/series, irrigation log as rows
+    measures = {'sensor': [], 'ts': [], 'val': []}
+    irrigation = []
+    for res in rows:
+        if res[1] == 'measure' and res[2] is not None:
+            measures['sensor'].append(res[2])
+            measures['ts'].append(res[3])
+            measures['val'].append(res[4])
+        elif res[1] == 'irrigation' and res[5] is not None:
+            irrigation.append(list(res[5:10]))
+
+    return rows[0][0], rows[-1][0], {'measures': measures, 'irrigation': irrigation}
+
+class SyncAgent:
+
+    def __init__(self, collector, node=None, batch_size=2000, interval=60, timeout=30, token=None):
+        self.url = collector.rstrip('/') + '/ingest'
+        self.node = node or socket.gethostname()
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+        self.token = token
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.worker = None
+        self.backoff = 0
+        self.epoch = None
+
+    def send(self, first_seq, last_seq, payload):
+
+        # returns the last sequence number the collector has of this node and epoch
+        body = dict(payload, node=self.node, epoch=self.epoch, first_seq=first_seq, last_seq=last_seq)
+        data = gzip.compress(json.dumps(body, separators=(',', ':')).encode())
+        req = urllib.request.Request(self.url, data=data, method='POST', headers={'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+        if self.token:
+            req.add_header('Authorization', 'Bearer ' + self.token)
+        with metrics.timer('irrigation_sync_send_seconds'):
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                ack = json.loads(response.read())
+        metrics.inc('irrigation_sync_bytes_total', len(data))
+        if ack.get('epoch') != self.epoch:
+            # collector without epochs would acknowledge sequence numbers of another outbox
+            raise RuntimeError('Collector acknowledged epoch ' + str(ack.get('epoch')) + ' instead of ' + self.epoch)
+        return ack['last_seq']
+
+    def sync_once(self):
+
+        # sends batches until the outbox is empty, returns the number of outbox entries sent
+        db = storage.get_connection()
+        with storage.transaction() as cur:
+            install(cur)
+            self.epoch = get_epoch(cur)
+
+        sent = 0
+        renewed = False
+        while not self.stopped:
+            batch = next_batch(db.cursor(), self.batch_size)
+            if batch is None:
+                break
+            first_seq, last_seq, payload = batch
+            try:
+                acked = self.send(first_seq, last_seq, payload)
+            except urllib.error.HTTPError as error:
+                if error.code != 409 or renewed:
+                    raise
+                # collector has other rows under these sequence numbers (database restored from a backup):
+                # send the outbox again under a new epoch, rows the collector has already are stored once
+                with storage.transaction() as cur:
+                    self.epoch = new_epoch(cur)
+                renewed = True
+                print('Collector refused sequence numbers', first_seq, 'to', last_seq, 'of', self.node + ', starting epoch', self.epoch)
+                continue
+            with storage.transaction() as cur:
+                cur.execute('DELETE FROM sync_outbox WHERE seq <= ?', (min(acked, last_seq), ))
+                count = cur.rowcount
+            sent = sent + count
+            metrics.inc('irrigation_sync_rows_total', count)
+            if acked < last_seq:
+                # collector didn't take it (shouldn't happen), don't loop on the same batch
+                raise RuntimeError('Collector acknowledged up to ' + str(acked) + ' of ' + str(last_seq))
+        return sent
+
+    def backlog(self):
+        try:
+            return storage.get_connection().execute('SELECT count(*) FROM sync_outbox').fetchone()[0]
+        except sqlite3.OperationalError:
+            # not installed yet (first sync still to come)
+            return 0
+
+    def start(self):
+        if self.worker is not None:
+            return
+        self.worker = threading.Thread(target=self.work, name='sync-agent', daemon=True)
+        self.worker.start()
+
+    def wake(self):
+        # e.g. right after a measurement, so the collector is up to date without waiting for the interval
+        self.wakeup.set()
+
+    def work(self):
+        while not self.stopped:
+            self.wakeup.clear()
+            try:
+                self.sync_once()
+                self.backoff = 0
+            except (urllib.error.URLError, OSError, ValueError, RuntimeError, sqlite3.Error) as error:
+                # collector offline or failing: keep the outbox and retry later, backing off up to an hour
+                metrics.inc('irrigation_sync_failures_total')
+                self.backoff = min(max(self.backoff * 2, self.interval), 3600)
+                print('Sync to', self.url, 'failed, retrying in', self.backoff, 's:', error)
+            self.wakeup.wait(self.backoff or self.interval)
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+def main(args):
+
+    parser = argparse.ArgumentParser(description='Send measures and irrigation log to a fleet collector')
+    parser.add_argument('database', nargs='?', default=storage.DATABASE)
+    parser.add_argument('--collector', help='e.g. http://localhost:5001')
+    parser.add_argument('--node', help='name of this Pi on the collector, default host name')
+    parser.add_argument('--token', help='shared token if the collector requires one')
+    parser.add_argument('--batch', type=int, default=2000, help='rows per batch')
+    parser.add_argument('--once', action='store_true', help='send the backlog and exit instead of syncing every --interval seconds')
+    parser.add_argument('--interval', type=int, default=60)
+    parser.add_argument('--uninstall', action='store_true', help='remove the outbox and its triggers, rows are not queued anymore')
+    args = parser.parse_args(args)
+    if not args.uninstall and args.collector is None:
+        parser.error('--collector is required')
+
+    storage.DATABASE = args.database
+    storage.init_schema(args.database)
+    if args.uninstall:
+        with storage.transaction() as cur:
+            count = uninstall(cur)
+        print('Removed sync outbox with', count, 'queued rows')
+        return 0
+    agent = SyncAgent(args.collector, args.node, args.batch, args.interval, token=args.token)
+    if args.once:
+        start = time.perf_counter()
+        sent = agent.sync_once()
+        print('Sent {} rows as {} in {:.1f} s'.format(sent, agent.node, time.perf_counter() - start))
+        return 0
+    agent.work()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime
+
+import storage
+import metrics
+
+# Optional write-behind buffer: measures and irrigation log rows are kept in memory and written together in
+# one transaction every `interval` seconds, or as soon as `max_batch` writes are waiting, instead of one
+# small transaction (and WAL write) each. Pending writes are flushed on shutdown (close()).
+# Valve switches are also appended to a small journal file before they are buffered: when the app dies before
+# a flush, replay() writes them at the next start, so a valve event is never lost.
+
+class WriteBuffer:
+
+    def __init__(self, interval=60, max_batch=100, journal=None, on_flush=None):
+        self.interval = interval
+        self.max_batch = max_batch
+        # next to the database by default, e.g. db/database-valves.jsonl
+        self.journal = journal or os.path.splitext(storage.DATABASE)[0] + '-valves.jsonl'
+        self.on_flush = on_flush
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.pending = []
+        self.closed = False
+        self.worker = None
+
+    def start(self):
+        self.replay()
+        self.worker = threading.Thread(target=self.work, name='write-buffer', daemon=True)
+        self.worker.start()
+
+    def add_measures(self, timestamp, values, samples=None):
+        self.add(('measures', timestamp, values, samples))
+
+    def add_irrigation_log(self, valve, timestamp, status, source, control_type, is_test=False):
+        entry = {'valve': valve, 'dt': str(timestamp), 'status': status, 'source': source, 'control_type': control_type, 'is_test': is_test}
+        self.add(('irrigation_log', valve, timestamp, status, source, control_type, is_test), entry)
+
+    def add(self, write, journal_entry=None):
+        with self.lock:
+            if journal_entry is not None:
+                # journal first (appended and synced, a few bytes) so the event survives a crash before the flush
+                with open(self.journal, 'a') as f:
+                    f.write(json.dumps(journal_entry) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.pending.append(write)
+            if len(self.pending) >= self.max_batch:
+                self.wakeup.notify()
+
+    def work(self):
+        while True:
+            with self.lock:
+                if not self.closed and len(self.pending) < self.max_batch:
+                    self.wakeup.wait(self.interval)
+                if self.closed:
+                    return
+            try:
+                self.flush()
+            except Exception as error:
+                # writes stay pending and are retried on the next flush
+                print('Failed to flush write buffer', error)
+
+    def flush(self):
+
+        # all pending writes in one transaction, in the order they were made
+        with self.flush_lock:
+            with self.lock:
+                batch = self.pending
+                self.pending = []
+            if len(batch) == 0:
+                return 0
+
+            start = time.perf_counter()
+            try:
+                with storage.transaction() as cur:
+                    for write in batch:
+                        if write[0] == 'measures':
+                            storage.insert_measures(cur, *write[1:])
+                        else:
+                            storage.insert_irrigation_log(cur, *write[1:])
+            except Exception:
+                with self.lock:
+                    self.pending = batch + self.pending
+                raise
+
+            with self.lock:
+                # everything journaled before this flush is in the database now, unless new valve events are waiting
+                if not any(write[0] == 'irrigation_log' for write in self.pending) and os.path.exists(self.journal):
+                    os.remove(self.journal)
+
+            metrics.observe('irrigation_write_flush_seconds', time.perf_counter() - start)
+            metrics.observe('irrigation_write_batch_size', len(batch))
+            if self.on_flush is not None:
+                self.on_flush()
+            return len(batch)
+
+    def replay(self):
+
+        # valve events journaled by a run that stopped before flushing them; events already in the log are skipped
+        if not os.path.exists(self.journal):
+            return 0
+        count = 0
+        with storage.transaction() as cur:
+            with open(self.journal) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line of a crash in the middle of a write
+                        continue
+                    if cur.execute('SELECT 1 FROM irrigation_log WHERE valve = ? AND dt = ? AND status = ?', (entry['valve'], entry['dt'], entry['status'])).fetchone() is not None:
+                        continue
+                    storage.insert_irrigation_log(cur, entry['valve'], datetime.fromisoformat(entry['dt']), entry['status'], entry['source'], entry['control_type'], entry['is_test'])
+                    count = count + 1
+        os.remove(self.journal)
+        if count > 0:
+            print('Replayed', count, 'valve events from', self.journal)
+        return count
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        self.flush()
+
+    def stats(self):
+        with self.lock:
+            return {'pending': len(self.pending)}